@@ -0,0 +1,286 @@
+"""
+An offline benchmark of the emoji ingestion pipeline.
+
+Generated PNG/JPEG/GIF/WebP fixtures are served from a local aiohttp server
+and run through the same functions add_emoji uses. Per-stage latency,
+throughput at different concurrency levels, and peak memory usage are
+reported.
+
+Run from the root of the repository:
+    python -m benchmarks.emoji_pipeline --concurrency 1 4 16
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import resource
+import statistics
+import time
+import typing
+
+import aiohttp
+import humanize
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
+import common.emoji_utils as emoji_utils
+import common.image_utils as image_utils
+
+# the same limit add_emoji uses for urls
+DOWNLOAD_LIMIT = 8388608
+
+# each is (name, format, width and height, frames)
+FIXTURES: tuple[tuple[str, str, int, int], ...] = (
+    ("small.png", "png", 128, 1),
+    ("large.png", "png", 1024, 1),
+    ("small.jpg", "jpg", 256, 1),
+    ("large.jpg", "jpg", 2048, 1),
+    ("static.webp", "webp", 1024, 1),
+    ("short.gif", "gif", 128, 8),
+    ("long.gif", "gif", 256, 64),
+    ("animated.webp", "webp", 256, 32),
+)
+
+
+def make_fixture(ext: str, size: int, frame_count: int, seed: int) -> bytes:
+    # upscaled noise is deterministic, looks vaguely like a photo, and
+    # compresses poorly - so it's a realistic worst case
+    rng = random.Random(seed)
+    noise_size = max(size // 8, 1)
+
+    frames = [
+        Image.frombytes(
+            "RGB", (noise_size, noise_size), rng.randbytes(noise_size * noise_size * 3)
+        ).resize((size, size), Image.Resampling.BICUBIC)
+        for _ in range(frame_count)
+    ]
+
+    output = io.BytesIO()
+    pillow_format = image_utils.PILLOW_FORMATS.get(ext, ext.upper())
+    if frame_count > 1:
+        frames[0].save(
+            output,
+            format=pillow_format,
+            save_all=True,
+            append_images=frames[1:],
+            duration=50,
+            loop=0,
+        )
+    else:
+        frames[0].save(output, format=pillow_format)
+    return output.getvalue()
+
+
+def make_app(fixtures: dict[str, bytes]) -> web.Application:
+    async def handle_fixture(request: web.Request) -> web.Response:
+        if (data := fixtures.get(request.match_info["name"])) is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    app = web.Application()
+    app.router.add_get("/{name}", handle_fixture)
+    return app
+
+
+async def timed(coro: typing.Awaitable[typing.Any]) -> tuple[float, typing.Any]:
+    start_time = time.perf_counter()
+    result = await coro
+    return time.perf_counter() - start_time, result
+
+
+async def run_pipeline(
+    session: aiohttp.ClientSession,
+    processor: image_utils.ImageProcessor,
+    url: str,
+) -> None:
+    # mirrors what add_emoji does with a url
+    ext, data = await emoji_utils.get_image_with_limit(session, url, DOWNLOAD_LIMIT)
+    if not ext or not data:
+        raise ValueError(f"{url} isn't an image!")
+
+    if (
+        ext in emoji_utils.ANIMATABLE_EXTS
+        and emoji_utils.animated_from_bytes(data) is None
+    ):
+        await processor.is_animated(data)
+    if len(data) > image_utils.EMOJI_SIZE_LIMIT:
+        await processor.fit_to_emoji(data, ext)
+
+
+async def bench_stages(
+    session: aiohttp.ClientSession,
+    processor: image_utils.ImageProcessor,
+    server: TestServer,
+    fixtures: dict[str, bytes],
+    iterations: int,
+) -> None:
+    print(
+        f"{'fixture':<16}{'size':>12}{'stage':>16}{'median':>12}{'p95':>12}"
+        f"{'output':>12}"
+    )
+
+    for name, ext, _, _ in FIXTURES:
+        url = str(server.make_url(f"/{name}"))
+        timings: dict[str, list[float]] = {}
+        output_size = None
+
+        for _ in range(iterations):
+            elapsed, data = await timed(
+                emoji_utils.get_file_with_limit(session, url, DOWNLOAD_LIMIT)
+            )
+            timings.setdefault("download", []).append(elapsed)
+
+            elapsed, _ = await timed(
+                emoji_utils.get_image_with_limit(session, url, DOWNLOAD_LIMIT)
+            )
+            timings.setdefault("sniff+download", []).append(elapsed)
+
+            # like add_emoji, only decode when the header can't say
+            if (
+                ext in emoji_utils.ANIMATABLE_EXTS
+                and emoji_utils.animated_from_bytes(data) is None
+            ):
+                elapsed, _ = await timed(processor.is_animated(data))
+                timings.setdefault("is_animated", []).append(elapsed)
+
+            if len(data) > image_utils.EMOJI_SIZE_LIMIT:
+                elapsed, compressed = await timed(processor.fit_to_emoji(data, ext))
+                timings.setdefault("compress", []).append(elapsed)
+                output_size = len(compressed)
+
+        for stage, stage_timings in timings.items():
+            # the output size is only meaningful for compression
+            output = (
+                humanize.naturalsize(output_size, binary=True)
+                if stage == "compress" and output_size is not None
+                else ""
+            )
+            print(
+                f"{name:<16}"
+                f"{humanize.naturalsize(len(fixtures[name]), binary=True):>12}"
+                f"{stage:>16}"
+                f"{statistics.median(stage_timings) * 1000:>10.1f}ms"
+                f"{_percentile(stage_timings, 0.95) * 1000:>10.1f}ms"
+                f"{output:>12}"
+            )
+
+
+async def bench_throughput(
+    session: aiohttp.ClientSession,
+    processor: image_utils.ImageProcessor,
+    server: TestServer,
+    concurrency_levels: list[int],
+    total_requests: int,
+) -> None:
+    urls = [str(server.make_url(f"/{name}")) for name, _, _, _ in FIXTURES]
+
+    print(f"\n{'concurrency':<16}{'download':>16}{'pipeline':>16}")
+
+    for concurrency in concurrency_levels:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def download(url: str) -> None:
+            async with semaphore:
+                await emoji_utils.get_file_with_limit(session, url, DOWNLOAD_LIMIT)
+
+        async def pipeline(url: str) -> None:
+            async with semaphore:
+                await run_pipeline(session, processor, url)
+
+        results: list[float] = []
+        for func in (download, pipeline):
+            elapsed, _ = await timed(
+                asyncio.gather(
+                    *(func(urls[i % len(urls)]) for i in range(total_requests))
+                )
+            )
+            results.append(total_requests / elapsed)
+
+        print(f"{concurrency:<16}{results[0]:>12.1f}/sec{results[1]:>12.1f}/sec")
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def _peak_rss() -> int:
+    # ru_maxrss is in kibibytes on linux, which is all the bot runs on
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _worker_peak_rss() -> tuple[int, int]:
+    # runs in a worker - they're children of the forkserver rather than of this
+    # process, so RUSAGE_CHILDREN here would never count them
+    # sleeping keeps this worker busy, so every worker ends up running one
+    time.sleep(0.5)
+    return os.getpid(), _peak_rss()
+
+
+async def main(args: argparse.Namespace) -> None:
+    fixtures = {
+        name: make_fixture(ext, size, frame_count, seed)
+        for seed, (name, ext, size, frame_count) in enumerate(FIXTURES)
+    }
+
+    server = TestServer(make_app(fixtures))
+    await server.start_server()
+
+    session = emoji_utils.create_session()
+    processor = image_utils.ImageProcessor(args.workers)
+
+    try:
+        await bench_stages(session, processor, server, fixtures, args.iterations)
+        await bench_throughput(
+            session, processor, server, args.concurrency, args.requests
+        )
+        worker_rss = dict(
+            await asyncio.gather(
+                *(processor._run(_worker_peak_rss) for _ in range(args.workers))
+            )
+        )
+    finally:
+        await session.close()
+        processor.close()
+        await server.close()
+
+    print(
+        f"\npeak rss: {humanize.naturalsize(_peak_rss(), binary=True)} (bot),"
+        f" {humanize.naturalsize(max(worker_rss.values()), binary=True)}"
+        " (largest worker)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the emoji ingestion pipeline against local fixtures."
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        help="How many times to run each stage per fixture.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16],
+        help="The concurrency levels to measure throughput at.",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=64,
+        help="How many requests to make per concurrency level.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="How many image processing workers to use.",
+    )
+    asyncio.run(main(parser.parse_args()))
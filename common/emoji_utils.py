@@ -1,107 +1,536 @@
 import asyncio
+import collections
+import contextlib
+import os
 import re
 import typing
+import urllib.parse
+from pathlib import Path
 
 import aiohttp
 import humanize
 import interactions as ipy
 
+import common.metrics as metrics
+
 DISCORD_EMOJI_REGEX = re.compile(r"<(a?):([a-zA-Z0-9\_]{1,32}):([0-9]{15,})>")
+CDN_EMOJI_REGEX = re.compile(
+    rf"{re.escape(ipy.Asset.BASE)}/emojis/([0-9]{{15,}})\.(png|gif)"
+)
+# no avifs - interactions.py can't tell discord they're avifs when uploading,
+# and pillow can't decode them to compress them
 IMAGE_EXTS = {"jpg", "jpeg", "png", "gif", "webp"}
+# discord shows apngs as static images, so only these count as animated emojis
+ANIMATABLE_EXTS = {"gif", "webp"}
 
+# how much of a file is needed to determine its type (and usually if it's animated)
+HEADER_SIZE = 64
+# each is the file type, and the (offset, bytes) pairs a file of it has to match
+# the order matters - the first match wins
+SIGNATURES: tuple[tuple[str, tuple[tuple[int, bytes], ...]], ...] = (
+    ("png", ((0, b"\x89PNG\r\n\x1a\n"),)),
+    # jfif, exif, and raw jpgs all start with this
+    ("jpg", ((0, b"\xff\xd8\xff"),)),
+    ("gif", ((0, b"GIF87a"),)),
+    ("gif", ((0, b"GIF89a"),)),
+    # the four bytes in between are the file size
+    ("webp", ((0, b"RIFF"), (8, b"WEBP"))),
+)
 
-async def type_from_url(url: str) -> typing.Optional[str]:
-    # gets type of data from url
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                return None
-
-            data = await resp.content.read(12)
-            tup_data = tuple(data)
-
-            # first 7 bytes of most pngs
-            png_list = (0x89, 0x50, 0x4E, 0x47, 0x0D, 0x0A, 0x1A, 0x0A)
-            if tup_data[:8] == png_list:
-                return "png"
-
-            # fmt: off
-            # first 12 bytes of most jp(e)gs. EXIF is a bit wierd, and so some manipulating has to be done
-            jfif_list = (0xFF, 0xD8, 0xFF, 0xE0, 0x00, 0x10, 0x4A, 0x46,
-                0x49, 0x46, 0x00, 0x01)
-            # fmt: on
-            exif_lists = (
-                (0xFF, 0xD8, 0xFF, 0xE1),
-                (0x45, 0x78, 0x69, 0x66, 0x00, 0x00),
-            )
 
-            if tup_data == jfif_list or (
-                tup_data[:4] == exif_lists[0] and tup_data[6:] == exif_lists[1]
-            ):
-                return "jpg"
+def create_session() -> aiohttp.ClientSession:
+    # makes the bot-wide session all emoji downloads go through
+    # most requests hit the same few hosts (mainly discord's cdn), so keeping
+    # connections alive and caching dns lookups avoids redoing handshakes
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=10,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+class DownloadTicket:
+    # a reservation for one download, handed out by DownloadScheduler
+    __slots__ = ("scheduler", "host", "guild_id", "size", "future")
+
+    def __init__(
+        self,
+        scheduler: "DownloadScheduler",
+        host: str,
+        guild_id: typing.Optional[int],
+        size: int,
+    ) -> None:
+        self.scheduler = scheduler
+        self.host = host
+        self.guild_id = guild_id
+        self.size = size
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    def fit_to_response(self, resp: aiohttp.ClientResponse) -> None:
+        # once it's known how large the file is, the rest of the reservation can
+        # be given back - unless the body is compressed, as then the length is
+        # of the compressed data
+        if resp.content_length is None or "Content-Encoding" in resp.headers:
+            return
+        self.scheduler._shrink(self, resp.content_length)
+
+
+class DownloadScheduler:
+    """
+    Limits how many downloads can run at once, and how much memory they can use.
+
+    Each download reserves the most it could read from a global byte budget,
+    and counts against per-host and per-guild limits. Downloads that can't
+    start yet wait in per-guild queues, which are served round-robin so that
+    one guild adding lots of emojis doesn't hold up everyone else.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_bytes: int,
+        max_per_host: int,
+        max_per_guild: int,
+        total_timeout: float,
+        idle_timeout: float,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_per_host = max_per_host
+        self.max_per_guild = max_per_guild
+        # sock_read is how long to wait for more data before giving up
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_read=idle_timeout
+        )
+
+        self.bytes_in_use = 0
+        self._host_counts: collections.Counter[str] = collections.Counter()
+        self._guild_counts: collections.Counter[typing.Optional[int]] = (
+            collections.Counter()
+        )
+        self._queues: collections.OrderedDict[
+            typing.Optional[int], collections.deque[DownloadTicket]
+        ] = collections.OrderedDict()
+
+    def _start(self, ticket: DownloadTicket) -> None:
+        self.bytes_in_use += ticket.size
+        self._host_counts[ticket.host] += 1
+        self._guild_counts[ticket.guild_id] += 1
+        ticket.future.set_result(None)
+
+    def _release(self, ticket: DownloadTicket) -> None:
+        self.bytes_in_use -= ticket.size
+
+        # remove empty entries, or else every host ever seen would stick around
+        self._host_counts[ticket.host] -= 1
+        if self._host_counts[ticket.host] <= 0:
+            del self._host_counts[ticket.host]
+
+        self._guild_counts[ticket.guild_id] -= 1
+        if self._guild_counts[ticket.guild_id] <= 0:
+            del self._guild_counts[ticket.guild_id]
+
+        self._dispatch()
+
+    def _remove(self, ticket: DownloadTicket) -> None:
+        if queue := self._queues.get(ticket.guild_id):
+            with contextlib.suppress(ValueError):
+                queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.guild_id]
+
+        self._dispatch()
+
+    def _shrink(self, ticket: DownloadTicket, size: int) -> None:
+        if size < ticket.size:
+            self.bytes_in_use -= ticket.size - size
+            ticket.size = size
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        # goes through the guilds round-robin, starting the first download of
+        # each that can start, until none can
+        # if one has to wait on the byte budget, nothing else is started until it
+        # can, so large downloads aren't starved by a stream of smaller ones
+        started = True
+        while started and self._queues:
+            started = False
+
+            for guild_id in list(self._queues):
+                queue = self._queues[guild_id]
+
+                # cancelled downloads remove themselves, but may not have yet
+                while queue and queue[0].future.cancelled():
+                    queue.popleft()
+                if not queue:
+                    del self._queues[guild_id]
+                    continue
+
+                ticket = queue[0]
+
+                if self.bytes_in_use + ticket.size > self.max_bytes:
+                    return
+                if (
+                    self._host_counts[ticket.host] >= self.max_per_host
+                    or self._guild_counts[guild_id] >= self.max_per_guild
+                ):
+                    continue
+
+                queue.popleft()
+                if queue:
+                    self._queues.move_to_end(guild_id)
+                else:
+                    del self._queues[guild_id]
+
+                self._start(ticket)
+                started = True
+
+    @contextlib.asynccontextmanager
+    async def reserve(
+        self, url: str, size: int, *, guild_id: typing.Optional[int] = None
+    ) -> typing.AsyncIterator[DownloadTicket]:
+        # waits until a download of up to size bytes from url can start
+        try:
+            host = urllib.parse.urlsplit(url).hostname or ""
+        except ValueError:
+            # aiohttp will complain about the url later on
+            host = ""
+
+        # anything larger than the whole budget would never start otherwise
+        ticket = DownloadTicket(self, host, guild_id, min(size, self.max_bytes))
+        self._queues.setdefault(guild_id, collections.deque()).append(ticket)
+        self._dispatch()
+
+        try:
+            with metrics.REGISTRY.time("download_queue_seconds"):
+                await ticket.future
+        except asyncio.CancelledError:
+            # the download may have been started just before being cancelled
+            if ticket.future.cancelled():
+                self._remove(ticket)
+            else:
+                self._release(ticket)
+            raise
+
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+
+def _reserve(
+    scheduler: typing.Optional[DownloadScheduler],
+    url: str,
+    size: int,
+    guild_id: typing.Optional[int],
+) -> typing.AsyncContextManager[typing.Optional[DownloadTicket]]:
+    if scheduler:
+        return scheduler.reserve(url, size, guild_id=guild_id)
+    return contextlib.nullcontext()
+
+
+class EmojiCache:
+    """
+    An on-disk, size-bounded LRU cache of emoji files from Discord's CDN.
+
+    Files are stored as `{emoji_id}.{format}`, which is safe as emoji assets
+    never change for a given ID.
+    """
+
+    def __init__(self, path: str | os.PathLike, max_size: int) -> None:
+        self.path = Path(path)
+        self.max_size = max_size
+        self.size = 0
+        self._entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # rebuild the lru order from what's already on disk, oldest first
+        files = sorted(
+            (f for f in self.path.iterdir() if f.is_file() and f.suffix != ".tmp"),
+            key=lambda f: f.stat().st_mtime,
+        )
+        for file in files:
+            file_size = file.stat().st_size
+            self._entries[file.name] = file_size
+            self.size += file_size
+
+        self._evict()
+
+    def _read(self, key: str) -> bytes:
+        # bump the mtime so the lru order survives restarts
+        os.utime(self.path / key)
+        with open(self.path / key, "rb") as f:
+            return f.read()
+
+    def _write(self, key: str, data: bytes | memoryview) -> None:
+        # write to a temporary file first so readers never see partial files
+        tmp_path = self.path / f"{key}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path / key)
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and self._entries:
+            key, file_size = self._entries.popitem(last=False)
+            self.size -= file_size
+            (self.path / key).unlink(missing_ok=True)
+
+    async def get(self, key: str) -> typing.Optional[bytes]:
+        if key not in self._entries:
+            return None
+
+        try:
+            data = await asyncio.to_thread(self._read, key)
+        except OSError:
+            self.size -= self._entries.pop(key, 0)
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        return data
 
-            # first 3 bytes of some jp(e)gs.
-            if tup_data[:3] == (0xFF, 0xD8, 0xFF):
-                return "jpg"
+    async def put(self, key: str, data: bytes | memoryview) -> None:
+        if key in self._entries or len(data) > self.max_size:
+            return
 
-            # copied from d.py's _get_mime_type_for_image
-            if tup_data[:3] == b"\xff\xd8\xff" or tup_data[6:10] in (
-                b"JFIF",
-                b"Exif",
-            ):
-                return "jpg"
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError:
+            return
 
-            # first 6 bytes of most gifs. last two can be different, so we have to handle that
-            gif_lists = ((0x47, 0x49, 0x46, 0x38), ((0x37, 0x61), (0x39, 0x61)))
-            if tup_data[:4] == gif_lists[0] and tup_data[4:6] in gif_lists[1]:
-                return "gif"
+        if key not in self._entries:
+            self._entries[key] = len(data)
+            self.size += len(data)
+            self._evict()
 
-            # first 12 bytes of most webps. middle four are file size, so we ignore that
-            webp_lists = ((0x52, 0x49, 0x46, 0x46), (0x57, 0x45, 0x42, 0x50))
-            if tup_data[:4] == webp_lists[0] and tup_data[8:] == webp_lists[1]:
-                return "webp"
 
+def _matches(data: bytes | memoryview, offset: int, signature: bytes) -> bool:
+    # slicing a memoryview doesn't copy, so this works for both without conversion
+    return data[offset : offset + len(signature)] == signature
+
+
+def type_from_bytes(data: bytes | memoryview) -> typing.Optional[str]:
+    # gets type of data from the first few bytes of it
+    for file_type, checks in SIGNATURES:
+        if all(_matches(data, offset, signature) for offset, signature in checks):
+            return file_type
+    return None
+
+
+def _webp_is_animated(data: bytes | memoryview) -> typing.Optional[bool]:
+    # simple webps (VP8/VP8L) can't be animated, while extended ones (VP8X)
+    # have a flag for it
+    chunk_type = data[12:16]
+    if chunk_type in (b"VP8 ", b"VP8L"):
+        return False
+    if chunk_type == b"VP8X" and len(data) > 20:
+        return bool(data[20] & 0x02)
     return None
 
 
-async def get_image_url(url: str):
-    # handles getting true image url from a url
+def animated_from_bytes(data: bytes | memoryview) -> typing.Optional[bool]:
+    # determines if an image is animated from the first few bytes of it
+    # this is None if that can't be determined from the header alone, like
+    # with gifs - those need to be decoded (see ImageProcessor.is_animated)
+    file_type = type_from_bytes(data)
+    if file_type == "jpg":
+        return False
+    if file_type == "webp":
+        return _webp_is_animated(data)
+    return None
+
 
+async def _read_header(resp: aiohttp.ClientResponse) -> bytes:
     try:
-        file_type = await type_from_url(url)
-    except aiohttp.InvalidURL:
-        return (None, None)
+        return await resp.content.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+def _limit_error(limit: int, *, equal_to: bool = True) -> ipy.errors.BadArgument:
+    if equal_to:
+        return ipy.errors.BadArgument(
+            f"The file/URL given is over {humanize.naturalsize(limit, binary=True)}!"
+        )
+    return ipy.errors.BadArgument(
+        "The file/URL given is at or over"
+        f" {humanize.naturalsize(limit, binary=True)}!"
+    )
 
-    return (url, file_type) if file_type in IMAGE_EXTS else (None, None)
 
+def _timeout_error() -> ipy.errors.BadArgument:
+    return ipy.errors.BadArgument("The file/URL given took too long to download!")
 
-async def get_file_with_limit(url: str, limit: int, *, equal_to: bool = True):
+
+async def _read_with_limit(
+    resp: aiohttp.ClientResponse,
+    limit: int,
+    *,
+    equal_to: bool = True,
+    already_read: bytes = b"",
+) -> memoryview:
+    # reads the rest of a response as long as it's under the limit (in bytes)
+    # already_read is whatever was taken off the stream before this was called
+    # everything is read into one buffer, and a view of it is returned so that
+    # it never has to be copied again
+    max_size = limit if equal_to else limit - 1
+
+    # most servers say how large the file is, so oversized files can be rejected
+    # before reading any of them, and the buffer can be made the right size
+    # the length may be of the compressed body, in which case the buffer grows
+    if resp.content_length is not None:
+        if resp.content_length > max_size:
+            raise _limit_error(limit, equal_to=equal_to)
+        buffer = bytearray(resp.content_length)
+    else:
+        buffer = bytearray()
+
+    buffer[: len(already_read)] = already_read
+    size = len(already_read)
+
+    async for chunk in resp.content.iter_any():
+        if size + len(chunk) > max_size:
+            raise _limit_error(limit, equal_to=equal_to)
+
+        buffer[size : size + len(chunk)] = chunk
+        size += len(chunk)
+
+    # the server sent less than it said it would
+    del buffer[size:]
+    return memoryview(buffer)
+
+
+async def get_file_with_limit(
+    session: aiohttp.ClientSession,
+    url: str,
+    limit: int,
+    *,
+    equal_to: bool = True,
+    cache: typing.Optional[EmojiCache] = None,
+    scheduler: typing.Optional[DownloadScheduler] = None,
+    guild_id: typing.Optional[int] = None,
+) -> memoryview:
     # gets a file as long as it's under the limit (in bytes)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                raise ipy.errors.BadArgument("I can't get this file/URL!")
-
-            try:
-                if equal_to:
-                    await resp.content.readexactly(
-                        limit + 1
-                    )  # we want this to error out even if the file is exactly the limit
-                    raise ipy.errors.BadArgument(
-                        "The file/URL given is over"
-                        f" {humanize.naturalsize(limit, binary=True)}!"
-                    )
-                else:
-                    await resp.content.readexactly(limit)
-                    raise ipy.errors.BadArgument(
-                        "The file/URL given is at or over"
-                        f" {humanize.naturalsize(limit, binary=True)}!"
+    # emojis on discord's cdn never change, so those can be served from the cache
+    # if a scheduler is passed, the download waits its turn there, and guild_id
+    # is who to count it against
+    cache_key = None
+    if cache and (match := CDN_EMOJI_REGEX.fullmatch(url)):
+        cache_key = f"{match[1]}.{match[2]}"
+
+        if (data := await cache.get(cache_key)) is not None:
+            metrics.REGISTRY.increment("emoji_cache_requests_total", result="hit")
+            if len(data) > limit or (not equal_to and len(data) == limit):
+                raise _limit_error(limit, equal_to=equal_to)
+            return memoryview(data)
+
+        metrics.REGISTRY.increment("emoji_cache_requests_total", result="miss")
+
+    try:
+        async with _reserve(scheduler, url, limit, guild_id) as ticket:
+            with metrics.REGISTRY.time("download_seconds"):
+                async with session.get(
+                    url, timeout=scheduler.timeout if scheduler else session.timeout
+                ) as resp:
+                    if resp.status != 200:
+                        raise ipy.errors.BadArgument("I can't get this file/URL!")
+
+                    if ticket:
+                        ticket.fit_to_response(resp)
+                    data = await _read_with_limit(resp, limit, equal_to=equal_to)
+    except asyncio.TimeoutError:
+        raise _timeout_error() from None
+
+    metrics.REGISTRY.observe("download_bytes", len(data), buckets=metrics.SIZE_BUCKETS)
+
+    if cache and cache_key:
+        await cache.put(cache_key, data)
+    return data
+
+
+async def get_image_with_limit(
+    session: aiohttp.ClientSession,
+    url: str,
+    limit: int,
+    *,
+    equal_to: bool = True,
+    scheduler: typing.Optional[DownloadScheduler] = None,
+    guild_id: typing.Optional[int] = None,
+) -> tuple[str, memoryview] | tuple[None, None]:
+    # gets an image as long as it's under the limit (in bytes), all in one request
+    # the type is sniffed from the start of the stream, and if it's an image,
+    # we just keep reading from where we left off
+    try:
+        async with _reserve(scheduler, url, limit, guild_id) as ticket:
+            async with session.get(
+                url, timeout=scheduler.timeout if scheduler else session.timeout
+            ) as resp:
+                if resp.status != 200:
+                    return (None, None)
+
+                if ticket:
+                    ticket.fit_to_response(resp)
+
+                header = await _read_header(resp)
+                file_type = type_from_bytes(header)
+                if file_type not in IMAGE_EXTS:
+                    return (None, None)
+
+                with metrics.REGISTRY.time("download_seconds"):
+                    data = await _read_with_limit(
+                        resp, limit, equal_to=equal_to, already_read=header
                     )
 
-            except asyncio.IncompleteReadError as e:
-                # essentially, we're exploting the fact that readexactly will error out if
-                # the url given is less than the limit
-                return e.partial
+                metrics.REGISTRY.observe(
+                    "download_bytes", len(data), buckets=metrics.SIZE_BUCKETS
+                )
+                return (file_type, data)
+    except aiohttp.InvalidURL:
+        return (None, None)
+    except asyncio.TimeoutError:
+        raise _timeout_error() from None
+
+
+class GuildEmojiIndex:
+    """
+    An index of a guild's custom emojis, for quick duplicate and slot checks.
+
+    This is rebuilt from GuildEmojisUpdate events, which always have the full
+    list of a guild's emojis.
+    """
+
+    def __init__(self, emojis: typing.Iterable[ipy.CustomEmoji]) -> None:
+        self.by_id: dict[int, ipy.CustomEmoji] = {}
+        self.names: collections.Counter[str] = collections.Counter()
+        self.animated_count = 0
+        self.static_count = 0
+
+        for emoji in emojis:
+            self.add(emoji)
+
+    def add(self, emoji: ipy.CustomEmoji) -> None:
+        if not emoji.id or int(emoji.id) in self.by_id:
+            return
+
+        self.by_id[int(emoji.id)] = emoji
+        if emoji.name:
+            self.names[emoji.name] += 1
+
+        if emoji.animated:
+            self.animated_count += 1
+        else:
+            self.static_count += 1
+
+    def has_id(self, emoji_id: int) -> bool:
+        return emoji_id in self.by_id
+
+    def has_name(self, name: str) -> bool:
+        return self.names[name] > 0
+
+    def count(self, *, animated: bool) -> int:
+        return self.animated_count if animated else self.static_count
 
 
 class CustomPartialEmojiConverter(ipy.Converter[ipy.PartialEmoji]):
@@ -0,0 +1,331 @@
+import asyncio
+import concurrent.futures
+import io
+import math
+import multiprocessing
+import time
+import typing
+
+from PIL import Image
+from PIL import ImageSequence
+
+import common.metrics as metrics
+
+# discord's limit for emoji files
+EMOJI_SIZE_LIMIT = 262144
+
+# pillow doesn't know "jpg" as a format name
+PILLOW_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG"}
+
+# strategies for animated images, from cheapest to most destructive
+# each is (max size, colors), where None for colors means the palette is left
+# alone - frames are dropped on top of these as needed, see _frame_step
+ANIMATED_STRATEGIES: tuple[tuple[int, int | None], ...] = (
+    (256, None),
+    (256, 128),
+    (256, 64),
+    (128, 64),
+    (128, 32),
+    (64, 32),
+)
+# likewise, but for static images, where the second value is either the colors
+# to use (for png/gif/webp) or the quality (for jpg)
+STATIC_STRATEGIES: tuple[tuple[int, int | None], ...] = (
+    (256, None),
+    (256, 128),
+    (256, 64),
+    (128, 64),
+    (128, 32),
+)
+JPEG_QUALITIES = {None: 85, 128: 70, 64: 50, 32: 35}
+# likewise, the quality for lossy webps in place of colors for animated strategies
+WEBP_QUALITIES = {None: 80, 128: 70, 64: 60, 32: 50}
+
+# bounds on the work done for one image, so that a single upload can't tie up
+# a worker for minutes or use gigabytes of memory
+# animated images with more pixels than this across all frames aren't decoded
+MAX_DECODED_PIXELS = 1024 * 1024 * 256
+# frames are dropped while decoding so no more than this many pixels are kept
+MAX_KEPT_PIXELS = 256 * 256 * 128
+# on top of that, attempts keep at least every nth frame
+MAX_FRAME_STEP = 8
+# no new attempts are started after this many seconds
+TIME_LIMIT = 10
+# how much of the size limit an attempt aims for when dropping frames, as the
+# estimate that's based on isn't exact
+SIZE_MARGIN = 0.9
+
+# what pillow raises for images it can't read - anything else is a bug
+IMAGE_ERRORS = (
+    OSError,
+    SyntaxError,
+    ValueError,
+    EOFError,
+    Image.DecompressionBombError,
+)
+
+# the functions below run in worker processes, so they have to be top-level
+# and should only deal with plain bytes
+
+
+def _is_animated(data: bytes | bytearray) -> bool:
+    with Image.open(io.BytesIO(data)) as image:
+        return getattr(image, "is_animated", False)
+
+
+def _resize(frame: Image.Image, size: int) -> Image.Image:
+    if frame.width <= size and frame.height <= size:
+        return frame
+
+    frame = frame.copy()
+    frame.thumbnail((size, size), Image.Resampling.LANCZOS)
+    return frame
+
+
+def _quantize(frame: Image.Image, colors: int) -> Image.Image:
+    # fast octree is the only method that handles transparency
+    return frame.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+
+
+def _gif_palette(frame: Image.Image) -> Image.Image:
+    # quantizing gives an rgba palette, which pillow writes broken gifs with
+    # gifs can only have an rgb palette with one transparent color, so convert
+    # it to that the same way pillow does when it quantizes for gifs itself
+    if frame.palette.mode != "RGBA":
+        return frame
+
+    for rgba, index in frame.palette.colors.items():
+        if rgba[3] == 0:
+            frame.info["transparency"] = index
+            break
+    frame.putpalette(frame.getpalette("RGB"), "RGB")
+    return frame
+
+
+def _save_animated(
+    frames: list[Image.Image],
+    durations: list[int],
+    loop: int,
+    *,
+    webp_quality: typing.Optional[int] = None,
+) -> bytes:
+    output = io.BytesIO()
+    if webp_quality:
+        frames[0].save(
+            output,
+            format="WEBP",
+            save_all=True,
+            append_images=frames[1:],
+            duration=durations,
+            loop=loop,
+            lossless=False,
+            quality=webp_quality,
+        )
+    else:
+        frames[0].save(
+            output,
+            format="GIF",
+            save_all=True,
+            append_images=frames[1:],
+            duration=durations,
+            loop=loop,
+            disposal=2,
+            optimize=True,
+        )
+    return output.getvalue()
+
+
+def _merge_durations(durations: list[int], step: int) -> list[int]:
+    # dropping frames means the ones left have to stay on screen longer
+    return [sum(durations[i : i + step]) for i in range(0, len(durations), step)]
+
+
+def _decode_frames(
+    image: Image.Image, size: int, step: int
+) -> tuple[list[Image.Image], list[int]]:
+    # frames are resized as they're decoded and only every nth one is kept, so
+    # the full-size frames are never all in memory at once
+    frames: list[Image.Image] = []
+    durations: list[int] = []
+
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        durations.append(frame.info.get("duration", 100))
+        if index % step == 0:
+            frames.append(_resize(frame.convert("RGBA"), size))
+
+    return frames, _merge_durations(durations, step)
+
+
+def _frame_step(frame_count: int, area: int, bytes_per_pixel: float) -> int:
+    # estimates how many frames have to be dropped for the image to fit,
+    # assuming its size grows linearly with the number of pixels in it
+    wanted_frames = EMOJI_SIZE_LIMIT * SIZE_MARGIN / (bytes_per_pixel * area)
+    return min(max(math.ceil(frame_count / wanted_frames), 1), MAX_FRAME_STEP)
+
+
+def _animated_candidates(image: Image.Image, ext: str) -> typing.Iterator[bytes]:
+    loop = image.info.get("loop", 0)
+    # this doesn't decode anything for gifs or webps
+    frame_count = getattr(image, "n_frames", 1)
+    if frame_count * image.width * image.height > MAX_DECODED_PIXELS:
+        return
+
+    max_size = ANIMATED_STRATEGIES[0][0]
+    scale = min(max_size / max(image.width, image.height), 1)
+    decode_step = math.ceil(
+        frame_count * image.width * image.height * scale**2 / MAX_KEPT_PIXELS
+    )
+    decoded, decoded_durations = _decode_frames(image, max_size, decode_step)
+
+    # animated webps compress far better as lossy webps than as gifs, so try
+    # that before falling back to gifs
+    formats = ("WEBP", "GIF") if ext == "webp" else ("GIF",)
+    # how many frames to drop is based on how well the last attempt in the same
+    # format compressed, as there's nothing to go off of before that
+    bytes_per_pixel: dict[str, float] = {}
+
+    for size, colors in ANIMATED_STRATEGIES:
+        resized = [_resize(f, size) for f in decoded]
+        area = resized[0].width * resized[0].height
+
+        for pillow_format in formats:
+            step = 1
+            if pillow_format in bytes_per_pixel:
+                step = _frame_step(len(resized), area, bytes_per_pixel[pillow_format])
+
+            new_frames = resized[::step]
+            new_durations = _merge_durations(decoded_durations, step)
+
+            if pillow_format == "WEBP":
+                candidate = _save_animated(
+                    new_frames,
+                    new_durations,
+                    loop,
+                    webp_quality=WEBP_QUALITIES[colors],
+                )
+            else:
+                if colors:
+                    new_frames = [
+                        _gif_palette(_quantize(f, colors)) for f in new_frames
+                    ]
+                candidate = _save_animated(new_frames, new_durations, loop)
+
+            bytes_per_pixel[pillow_format] = len(candidate) / (len(new_frames) * area)
+            yield candidate
+
+
+def _static_candidates(image: Image.Image, ext: str) -> typing.Iterator[bytes]:
+    pillow_format = PILLOW_FORMATS.get(ext, ext.upper())
+    is_jpeg = pillow_format == "JPEG"
+    frame = image.convert("RGB") if is_jpeg else image.convert("RGBA")
+
+    for size, colors in STATIC_STRATEGIES:
+        new_frame = _resize(frame, size)
+        output = io.BytesIO()
+
+        if is_jpeg:
+            new_frame.save(
+                output,
+                format=pillow_format,
+                optimize=True,
+                quality=JPEG_QUALITIES[colors],
+            )
+        else:
+            if colors:
+                new_frame = _quantize(new_frame, colors)
+                if pillow_format == "GIF":
+                    new_frame = _gif_palette(new_frame)
+            new_frame.save(output, format=pillow_format, optimize=True)
+
+        yield output.getvalue()
+
+
+def _fit_to_emoji(data: bytes | bytearray, ext: str) -> bytes | bytearray:
+    # tries progressively more lossy ways of shrinking the image until it fits,
+    # stopping as soon as one does or when out of time
+    # if nothing fits, the smallest attempt is returned
+    if len(data) <= EMOJI_SIZE_LIMIT:
+        return data
+
+    deadline = time.monotonic() + TIME_LIMIT
+
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            candidates = _animated_candidates(image, ext)
+        else:
+            candidates = _static_candidates(image, ext)
+
+        smallest = data
+        for candidate in candidates:
+            if len(candidate) <= EMOJI_SIZE_LIMIT:
+                return candidate
+            if len(candidate) < len(smallest):
+                smallest = candidate
+            if time.monotonic() > deadline:
+                break
+
+        return smallest
+
+
+def _picklable(data: bytes | memoryview) -> bytes | bytearray:
+    # memoryviews can't be sent to worker processes, but what they're a view of
+    # can be - so send that instead of copying it, if the view covers all of it
+    if isinstance(data, memoryview):
+        if isinstance(data.obj, (bytes, bytearray)) and data.nbytes == len(data.obj):
+            return data.obj
+        return data.tobytes()
+    return data
+
+
+class ImageProcessor:
+    """
+    Runs all Pillow work in a pool of worker processes.
+
+    Decoding and re-encoding large images (especially GIFs) can take
+    hundreds of milliseconds, which would otherwise block the event loop.
+    """
+
+    def __init__(self, max_workers: typing.Optional[int] = None) -> None:
+        self._max_workers = max_workers
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # forked workers would inherit the bot's threads' locks in whatever
+        # state they were in, so use a forkserver that only has this module
+        # loaded instead - main.py is guarded, so it's safe for it to import
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._max_workers, mp_context=context
+        )
+
+    async def _run(self, func: typing.Callable[..., typing.Any], *args: typing.Any):
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        with metrics.REGISTRY.time(
+            "image_processing_seconds", operation=func.__name__.removeprefix("_")
+        ):
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died (likely killed for using too much memory), which
+                # breaks the whole pool for good - so replace it, unless another
+                # task that was running on it already has
+                if self._executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._create_executor()
+                raise
+
+    async def is_animated(self, data: bytes | memoryview) -> bool:
+        return await self._run(_is_animated, _picklable(data))
+
+    async def fit_to_emoji(
+        self, data: bytes | memoryview, ext: str
+    ) -> bytes | bytearray:
+        # returns the data as-is if it already fits, otherwise tries to shrink it
+        # animated images are kept animated, though they may come back as gifs
+        # the result may still be too large, so callers should check that
+        return await self._run(_fit_to_emoji, _picklable(data), ext)
+
+    def close(self, *, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
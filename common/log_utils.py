@@ -0,0 +1,73 @@
+import json
+import logging.handlers
+import queue
+import typing
+
+# extra fields that are added to json logs if a record has them
+# pass these through the "extra" argument of logging calls
+EXTRA_FIELDS = ("guild", "command", "latency")
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as JSON lines, for easier parsing later."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: dict[str, typing.Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for field in EXTRA_FIELDS:
+            if (value := getattr(record, field, None)) is not None:
+                data[field] = value
+
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
+
+def setup_logging(
+    logger: logging.Logger,
+    filename: str,
+    *,
+    json_format: bool = False,
+    max_bytes: int = 0,
+    backup_count: int = 5,
+    rotate_when: typing.Optional[str] = None,
+) -> logging.handlers.QueueListener:
+    # the logger itself only puts records into a queue - the actual (blocking)
+    # file writes happen in the listener's thread, away from the event loop
+    # rotate_when rotates by time (see TimedRotatingFileHandler), while
+    # max_bytes rotates by size - only one of them can be used
+    file_handler: logging.FileHandler
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=rotate_when, backupCount=backup_count, encoding="utf-8"
+        )
+    elif max_bytes:
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename,
+            mode="a",
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+        )
+    else:
+        file_handler = logging.FileHandler(filename, encoding="utf-8", mode="a")
+
+    if json_format:
+        file_handler.setFormatter(JSONFormatter())
+    else:
+        file_handler.setFormatter(
+            logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
+        )
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
@@ -0,0 +1,157 @@
+import bisect
+import collections
+import contextlib
+import math
+import time
+import typing
+
+from aiohttp import web
+
+# this module is deliberately never reloaded by extensions, so that
+# REGISTRY (and everything recorded in it) lives as long as the bot does
+
+# in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+# in bytes, from 1 KiB to 16 MiB
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(8)) + (math.inf,)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        # an estimate - this returns the upper bound of the bucket the quantile is in
+        target = q * self.count
+        running = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            running += bucket_count
+            if running >= target:
+                return bound
+        return math.inf
+
+
+class Metrics:
+    """A small registry of counters and histograms, keyed by name and labels."""
+
+    def __init__(self) -> None:
+        self.counters: collections.defaultdict[str, collections.Counter[LabelKey]] = (
+            collections.defaultdict(collections.Counter)
+        )
+        self.histograms: dict[str, dict[LabelKey, Histogram]] = {}
+
+    def increment(self, name: str, amount: int = 1, **labels: str) -> None:
+        self.counters[name][tuple(sorted(labels.items()))] += amount
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        *,
+        buckets: tuple[float, ...] = TIME_BUCKETS,
+        **labels: str,
+    ) -> None:
+        histograms = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+
+        if (histogram := histograms.get(key)) is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels: str) -> typing.Iterator[None]:
+        # only records the time if the block doesn't error out
+        start_time = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def summary(self) -> str:
+        # a human-readable summary, for the debug metrics command
+        lines: list[str] = []
+
+        for name, histograms in sorted(self.histograms.items()):
+            lines.append(f"{name}:")
+            for key, histogram in sorted(histograms.items()):
+                average = histogram.sum / histogram.count
+                lines.append(
+                    f"  {_format_labels(key) or 'all'}: n={histogram.count}"
+                    f" avg={average:.3f} p50<={histogram.quantile(0.5)}"
+                    f" p95<={histogram.quantile(0.95)}"
+                )
+
+        for name, counter in sorted(self.counters.items()):
+            lines.append(f"{name}:")
+            for key, count in sorted(counter.items()):
+                lines.append(f"  {_format_labels(key) or 'all'}: {count}")
+
+        return "\n".join(lines) or "No metrics recorded yet."
+
+    def render_prometheus(self) -> str:
+        # renders everything in prometheus' text exposition format
+        lines: list[str] = []
+
+        for name, histograms in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in sorted(histograms.items()):
+                running = 0
+                for bound, bucket_count in zip(
+                    histogram.buckets, histogram.bucket_counts
+                ):
+                    running += bucket_count
+                    le = "+Inf" if bound == math.inf else str(bound)
+                    lines.append(
+                        f"{name}_bucket{{{_format_labels(key + (('le', le),))}}}"
+                        f" {running}"
+                    )
+
+                labels = f"{{{_format_labels(key)}}}" if key else ""
+                lines.append(f"{name}_sum{labels} {histogram.sum}")
+                lines.append(f"{name}_count{labels} {histogram.count}")
+
+        for name, counter in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for key, count in sorted(counter.items()):
+                labels = f"{{{_format_labels(key)}}}" if key else ""
+                lines.append(f"{name}{labels} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in key)
+
+
+REGISTRY = Metrics()
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    # serves REGISTRY for prometheus to scrape
+    # this isn't authenticated, so it should only be bound to a local address
+    async def handle_metrics(_: web.Request) -> web.Response:
+        return web.Response(
+            text=REGISTRY.render_prometheus(),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
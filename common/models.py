@@ -1,15 +1,107 @@
-import datetime
 import typing
 
 from beanie import Document
 from beanie import Indexed
+from pydantic import BaseModel
+from pymongo import ReplaceOne
+
+# bump this and add a migration to CONFIG_MIGRATIONS whenever Config's
+# stored format changes
+CONFIG_VERSION = 2
+
+
+class PinboardEntry(BaseModel):
+    # an entry_id of 0 means every channel in the guild
+    entry_id: int
+    destination_id: int
 
 
 class Config(Document):
-    guild_id: typing.Annotated[str, Indexed(str)]
-    pinboards: dict[str, str]
+    guild_id: typing.Annotated[int, Indexed(int)]
+    # mongodb only allows string keys, so this is a list rather than a dict
+    pinboards: list[PinboardEntry] = []
+    version: int = CONFIG_VERSION
+
+    def get_destination(self, channel_id: int) -> typing.Optional[int]:
+        # channel-specific pinboards take priority over the global one
+        global_destination = None
+
+        for pinboard in self.pinboards:
+            if pinboard.entry_id == channel_id:
+                return pinboard.destination_id
+            if pinboard.entry_id == 0:
+                global_destination = pinboard.destination_id
+
+        return global_destination
+
+    def set_pinboard(self, entry_id: int, destination_id: int) -> None:
+        self.remove_pinboard(entry_id)
+        self.pinboards.append(
+            PinboardEntry(entry_id=entry_id, destination_id=destination_id)
+        )
+
+    def remove_pinboard(self, entry_id: int) -> bool:
+        # returns if a pinboard was actually removed
+        old_len = len(self.pinboards)
+        self.pinboards = [p for p in self.pinboards if p.entry_id != entry_id]
+        return len(self.pinboards) != old_len
+
+
+class PinForward(Document):
+    # records where a pin was forwarded to, so it's never forwarded twice
+    source_id: typing.Annotated[int, Indexed(int, unique=True)]
+    forwarded_id: int
+    destination_id: int
+    guild_id: int
+
+
+def _migrate_config_v1(doc: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    # ids were stored as strings, and pinboards as a dict of entry -> destination
+    doc["guild_id"] = int(doc["guild_id"])
+    doc["pinboards"] = [
+        {"entry_id": int(k), "destination_id": int(v)}
+        for k, v in doc.get("pinboards", {}).items()
+    ]
+    return doc
+
+
+# maps a version to the function that migrates a raw document from it to the next
+CONFIG_MIGRATIONS: dict[
+    int, typing.Callable[[dict[str, typing.Any]], dict[str, typing.Any]]
+] = {
+    1: _migrate_config_v1,
+}
+
+
+async def migrate_configs() -> int:
+    # brings every outdated config up to CONFIG_VERSION, returning how many there were
+    # configs from before versioning have no version field, and are version 1
+    collection = Config.get_motor_collection()
+    requests: list[ReplaceOne] = []
+    migrated = 0
+
+    async for doc in collection.find(
+        {
+            "$or": [
+                {"version": {"$exists": False}},
+                {"version": {"$lt": CONFIG_VERSION}},
+            ]
+        }
+    ):
+        version = doc.get("version", 1)
+        while version < CONFIG_VERSION:
+            doc = CONFIG_MIGRATIONS[version](doc)
+            version += 1
+        doc["version"] = version
+
+        requests.append(ReplaceOne({"_id": doc["_id"]}, doc))
+        if len(requests) >= 1000:
+            await collection.bulk_write(requests, ordered=False)
+            migrated += len(requests)
+            requests.clear()
+
+    if requests:
+        await collection.bulk_write(requests, ordered=False)
+        migrated += len(requests)
 
-    class Settings:
-        use_cache = True
-        cache_expiration_time = datetime.timedelta(seconds=10)
-        cache_capacity = 5
+    return migrated
@@ -0,0 +1,112 @@
+import collections
+import time
+import typing
+
+import interactions as ipy
+
+# discord only shows up to 4 images in a gallery, and 10 embeds in a message
+MAX_GALLERY_IMAGES = 4
+MAX_EMBEDS = 10
+# how long (in seconds) an author's name and avatar are reused for
+AUTHOR_CACHE_TTL = 600
+AUTHOR_CACHE_SIZE = 1024
+
+
+class PinRenderer:
+    """
+    Turns a pinned message into the message to send to a pinboard.
+
+    Images, stickers and embeds from the original message are carried over
+    where Discord allows it. The name and avatar of recent authors are
+    memoized, as pins tend to come from the same few people.
+    """
+
+    def __init__(self) -> None:
+        self._authors: collections.OrderedDict[int, tuple[float, str, str]] = (
+            collections.OrderedDict()
+        )
+
+    def author_info(self, author: ipy.User | ipy.Member) -> tuple[str, str]:
+        author_id = int(author.id)
+        now = time.monotonic()
+
+        entry = self._authors.get(author_id)
+        if entry and now - entry[0] < AUTHOR_CACHE_TTL:
+            self._authors.move_to_end(author_id)
+            return entry[1], entry[2]
+
+        name = f"{author.display_name} ({author.tag})"
+        icon_url = author.display_avatar.url
+        self._authors[author_id] = (now, name, icon_url)
+        self._authors.move_to_end(author_id)
+
+        while len(self._authors) > AUTHOR_CACHE_SIZE:
+            self._authors.popitem(last=False)
+
+        return name, icon_url
+
+    def image_urls(self, pin: ipy.Message) -> list[str]:
+        urls = [a.url for a in pin.attachments if a.height]
+
+        # links to images get turned into image embeds by discord
+        urls.extend(
+            e.thumbnail.url
+            for e in pin.embeds
+            if e.type == ipy.EmbedType.IMAGE and e.thumbnail
+        )
+
+        # lottie stickers can't be shown in an embed
+        urls.extend(
+            f"{ipy.Asset.BASE}/stickers/{s.id}.png"
+            for s in pin.sticker_items or ()
+            if s.format_type != ipy.StickerFormatType.LOTTIE
+        )
+
+        return urls
+
+    def render(self, pin: ipy.Message) -> dict[str, typing.Any]:
+        # returns the arguments to pass to send
+        embed = ipy.Embed(
+            description=pin.content or pin.system_content,
+            color=ipy.RoleColors.LIGHTER_GRAY,
+            timestamp=pin.timestamp,
+            # embeds with the same url are merged into one with multiple images
+            url=pin.jump_url,
+        )
+        name, icon_url = self.author_info(pin.author)
+        embed.set_author(name, icon_url=icon_url)
+
+        if pin.attachments:
+            embed.add_field(
+                "Attachments",
+                "\n".join([f"[{x.filename}]({x.url})" for x in pin.attachments]),
+            )
+
+        if pin.sticker_items:
+            embed.add_field("Stickers", "\n".join(s.name for s in pin.sticker_items))
+
+        if not embed.description:
+            embed.description = "*See original message for content.*"
+
+        embeds = [embed]
+
+        image_urls = self.image_urls(pin)[:MAX_GALLERY_IMAGES]
+        if image_urls:
+            embed.set_image(image_urls[0])
+
+            for image_url in image_urls[1:]:
+                image_embed = ipy.Embed(url=pin.jump_url)
+                image_embed.set_image(image_url)
+                embeds.append(image_embed)
+
+        # rich embeds (like from other bots) are carried over as-is
+        embeds.extend(e for e in pin.embeds if e.type == ipy.EmbedType.RICH)
+
+        return {
+            "embeds": embeds[:MAX_EMBEDS],
+            "components": ipy.Button(
+                style=ipy.ButtonStyle.LINK,
+                label="Original Message",
+                url=pin.jump_url,
+            ),
+        }
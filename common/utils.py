@@ -1,6 +1,9 @@
+import asyncio
 import collections
+import contextlib
 import logging
 import os
+import time
 import traceback
 import typing
 from pathlib import Path
@@ -9,17 +12,27 @@ import aiohttp
 import interactions as ipy
 from interactions.ext import prefixed_commands as prefixed
 
+import common.metrics as metrics
 import common.models as models
 
 
 if typing.TYPE_CHECKING:
-    import asyncio
+    import common.emoji_utils as emoji_utils
+    import common.image_utils as image_utils
 
     class CherubBase(prefixed.PrefixedInjectedClient):
         init_load: bool
         fully_ready: asyncio.Event
         color: ipy.Color
         owner: ipy.User
+        session: aiohttp.ClientSession
+        emoji_cache: typing.Optional[emoji_utils.EmojiCache]
+        download_scheduler: emoji_utils.DownloadScheduler
+        image_processor: image_utils.ImageProcessor
+        emoji_indexes: dict[int, emoji_utils.GuildEmojiIndex]
+        config_cache: ConfigCache
+        pinboard_index: PinboardIndex
+        error_reporter: ErrorReporter
 
 else:
 
@@ -58,32 +71,138 @@ def error_embed_generate(error_msg: str):
     return ipy.Embed(color=ipy.RoleColors.RED, description=error_msg)
 
 
+class ErrorReporter:
+    """
+    Sends errors to the bot owner in the background.
+
+    Errors are collected for a few seconds at a time, identical ones are merged
+    together (with a count), and the result is sent with as many embeds per
+    message as Discord allows. The queue is bounded, so an error storm
+    drops errors rather than piling up.
+    """
+
+    def __init__(
+        self,
+        bot: CherubBase,
+        *,
+        max_queue_size: int = 100,
+        batch_interval: float = 5,
+        send_interval: float = 1,
+    ) -> None:
+        self.bot = bot
+        self.batch_interval = batch_interval
+        self.send_interval = send_interval
+        self._queue: asyncio.Queue[tuple[str, typing.Optional[str], bool]] = (
+            asyncio.Queue(maxsize=max_queue_size)
+        )
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    def report(
+        self, content: str, jump_url: typing.Optional[str] = None, *, code: bool = True
+    ) -> None:
+        # code is whether the content should be shown in a code block
+        with contextlib.suppress(asyncio.QueueFull):
+            self._queue.put_nowait((content, jump_url, code))
+
+    def _make_embeds(
+        self, content: str, jump_url: typing.Optional[str], code: bool, count: int
+    ) -> list[ipy.Embed]:
+        if code:
+            chunks = line_split(content, split_by=40)
+            for i in range(len(chunks)):
+                chunks[i][0] = f"```py\n{chunks[i][0]}"
+                chunks[i][-1] += "\n```"
+            embeds = [error_embed_generate("\n".join(chunk)) for chunk in chunks]
+        else:
+            embeds = [error_embed_generate(content)]
+
+        embeds[0].title = f"Error (x{count})" if count > 1 else "Error"
+        embeds[0].url = jump_url
+        return embeds
+
+    async def _run(self) -> None:
+        while True:
+            reports = [await self._queue.get()]
+
+            # wait a bit to catch any other errors from the same burst
+            await asyncio.sleep(self.batch_interval)
+            while not self._queue.empty():
+                reports.append(self._queue.get_nowait())
+
+            # dicts keep insertion order, so errors are still sent in order
+            counts: dict[tuple[str, bool], list[typing.Any]] = {}
+            for content, jump_url, code in reports:
+                if (key := (content, code)) in counts:
+                    counts[key][1] += 1
+                else:
+                    counts[key] = [jump_url, 1]
+
+            embeds: list[ipy.Embed] = []
+            for (content, code), (jump_url, count) in counts.items():
+                embeds.extend(self._make_embeds(content, jump_url, code, count))
+
+            for batch in _batch_embeds(embeds):
+                try:
+                    await self.bot.owner.send(embeds=batch)
+                except Exception:
+                    logging.getLogger("cherub").exception(
+                        "Failed to send errors to the owner."
+                    )
+                await asyncio.sleep(self.send_interval)
+
+
+def _batch_embeds(embeds: list[ipy.Embed]) -> list[list[ipy.Embed]]:
+    # discord allows 10 embeds per message, with 6000 characters between them
+    batches: list[list[ipy.Embed]] = []
+    current: list[ipy.Embed] = []
+    current_length = 0
+
+    for embed in embeds:
+        length = len(embed.title or "") + len(embed.description or "")
+        if current and (len(current) >= 10 or current_length + length > 6000):
+            batches.append(current)
+            current = []
+            current_length = 0
+
+        current.append(embed)
+        current_length += length
+
+    if current:
+        batches.append(current)
+    return batches
+
+
 async def error_handle(
     bot: CherubBase,
     error: Exception,
     ctx: typing.Optional[ipy.BaseContext] = None,
 ):
     # handles errors and sends them to owner
+    # the owner is notified in the background, so the user isn't kept waiting
+    jump_url = None
+    if ctx and hasattr(ctx, "message") and hasattr(ctx.message, "jump_url"):
+        jump_url = ctx.message.jump_url
+
     if isinstance(error, aiohttp.ServerDisconnectedError):
-        to_send = "Disconnected from server!"
+        bot.error_reporter.report("Disconnected from server!", jump_url, code=False)
     else:
         error_str = error_format(error)
-        logging.getLogger("cherub").error(error_str)
-
-        chunks = line_split(error_str, split_by=40)
-        for i in range(len(chunks)):
-            chunks[i][0] = f"```py\n{chunks[i][0]}"
-            chunks[i][-1] += "\n```"
-
-        final_chunks: list[str | ipy.Embed] = [
-            error_embed_generate("\n".join(chunk)) for chunk in chunks
-        ]
-        if ctx and hasattr(ctx, "message") and hasattr(ctx.message, "jump_url"):
-            final_chunks.insert(0, f"Error on: {ctx.message.jump_url}")
-
-        to_send = final_chunks
-
-    await msg_to_owner(bot, to_send)
+        logging.getLogger("cherub").error(
+            error_str,
+            extra={
+                "guild": getattr(ctx, "guild_id", None),
+                "command": getattr(ctx, "invoke_target", None),
+                "latency": command_latency(ctx) if ctx else None,
+            },
+        )
+        bot.error_reporter.report(error_str, jump_url)
 
     if ctx:
         if isinstance(ctx, prefixed.PrefixedContext):
@@ -104,26 +223,6 @@ def error_format(error: Exception):
     return "".join(traceback.format_exception(error))
 
 
-def string_split(string: str):
-    # simple function that splits a string into 1950-character parts
-    return [string[i : i + 1950] for i in range(0, len(string), 1950)]
-
-
-async def msg_to_owner(
-    bot: CherubBase,
-    chunks: list[str] | list[ipy.Embed] | list[str | ipy.Embed] | str | ipy.Embed,
-):
-    if not isinstance(chunks, list):
-        chunks = [chunks]
-
-    # sends a message to the owner
-    for chunk in chunks:
-        if isinstance(chunk, ipy.Embed):
-            await bot.owner.send(embeds=chunk)
-        else:
-            await bot.owner.send(chunk)
-
-
 def line_split(content: str, split_by=20):
     content_split = content.splitlines()
     return [
@@ -173,14 +272,135 @@ def make_embed(description: str, *, title: str | None = None) -> ipy.Embed:
     )
 
 
-async def fetch_config(guild_id: ipy.Snowflake_Type):
-    maybe_config = await models.Config.find_one(models.Config.guild_id == str(guild_id))
+class ConfigCache:
+    """
+    An LRU cache of guild configs, keyed by guild ID.
+
+    Entries never expire on their own - instead, everything that changes a
+    config goes through save_config, which keeps this up to date. A guild's
+    entry is dropped when the bot leaves it.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._configs: collections.OrderedDict[int, models.Config] = (
+            collections.OrderedDict()
+        )
+
+    def get(self, guild_id: int) -> typing.Optional[models.Config]:
+        if (config := self._configs.get(guild_id)) is not None:
+            self._configs.move_to_end(guild_id)
+        return config
+
+    def put(self, guild_id: int, config: models.Config) -> None:
+        self._configs[guild_id] = config
+        self._configs.move_to_end(guild_id)
+
+        while len(self._configs) > self.capacity:
+            self._configs.popitem(last=False)
+
+    def pop(self, guild_id: int) -> None:
+        self._configs.pop(guild_id, None)
+
+
+class PinboardIndex:
+    """
+    Tracks which guilds and entry channels have pinboards.
+
+    This lets the pin listener skip everything else without any I/O.
+    An entry channel ID of 0 means every channel in the guild.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[int, frozenset[int]] = {}
+
+    def update(self, config: models.Config) -> None:
+        if config.pinboards:
+            self._entries[config.guild_id] = frozenset(
+                p.entry_id for p in config.pinboards
+            )
+        else:
+            self._entries.pop(config.guild_id, None)
+
+    def remove(self, guild_id: int) -> None:
+        self._entries.pop(guild_id, None)
+
+    def has_pinboard(self, guild_id: int, channel_id: int) -> bool:
+        entries = self._entries.get(guild_id)
+        return entries is not None and (0 in entries or channel_id in entries)
+
+
+async def load_configs(bot: CherubBase) -> None:
+    # streams every config into the cache and pinboard index at startup, so that
+    # a guild's first pin or pinboard command doesn't have to wait on the database
+    # every config has to be indexed, but only as many as fit are cached - past
+    # that, the cache would just be evicting what it loaded moments ago
+    # configs with pinboards are what pins need, so they're cached before the
+    # rest, which only fill whatever room is left
+    logger = logging.getLogger("cherub")
+    start_time = time.perf_counter()
+    bot.pinboard_index = PinboardIndex()
+    capacity = bot.config_cache.capacity
+    with_pinboards: list[models.Config] = []
+    without_pinboards: list[models.Config] = []
+    count = 0
+
+    async for config in models.Config.find_all():
+        bot.pinboard_index.update(config)
+        count += 1
+
+        if config.pinboards:
+            if len(with_pinboards) < capacity:
+                with_pinboards.append(config)
+        elif len(without_pinboards) < capacity:
+            without_pinboards.append(config)
+
+    # the ones with pinboards go in last, so they're the last to be evicted
+    to_cache = without_pinboards[: capacity - len(with_pinboards)] + with_pinboards
+    for config in to_cache:
+        bot.config_cache.put(config.guild_id, config)
+    cached = len(to_cache)
+
+    if count > cached:
+        logger.warning(
+            f"Only {cached} of {count} configs fit in the config cache. Consider"
+            " raising CONFIG_CACHE_CAPACITY."
+        )
+
+    logger.info(
+        f"Indexed {count} configs and cached {cached} of them in"
+        f" {time.perf_counter() - start_time:.2f} seconds."
+    )
+
+
+async def fetch_config(bot: CherubBase, guild_id: ipy.Snowflake_Type):
+    # this never writes to the database - if a guild has no config, a default one
+    # is made and cached, and only gets inserted once save_config is used on it
+    if (config := bot.config_cache.get(int(guild_id))) is not None:
+        return config
+
+    maybe_config = await models.Config.find_one(models.Config.guild_id == int(guild_id))
     if maybe_config is None:
-        maybe_config = models.Config(guild_id=str(guild_id), pinboards={})
-        await maybe_config.create()
+        maybe_config = models.Config(guild_id=int(guild_id))
+
+    bot.config_cache.put(int(guild_id), maybe_config)
     return maybe_config
 
 
+async def save_config(bot: CherubBase, config: models.Config):
+    # this inserts the config if it isn't in the database yet
+    # configs are edited in place, so if saving fails, the cached one
+    # can't be trusted anymore
+    try:
+        await config.save()
+    except Exception:
+        bot.config_cache.pop(config.guild_id)
+        raise
+
+    bot.config_cache.put(config.guild_id, config)
+    bot.pinboard_index.update(config)
+
+
 class CustomCheckFailure(ipy.errors.BadArgument):
     # custom classs for custom prerequisite failures outside of normal command checks
     pass
@@ -201,8 +421,40 @@ async def _global_checks(ctx: CherubContext):
     return ctx.bot.fully_ready.is_set()
 
 
+def command_latency(ctx: ipy.BaseContext) -> typing.Optional[float]:
+    # how long (in seconds) a command has been running for, if it's known
+    if (start_time := getattr(ctx, "metrics_start", None)) is None:
+        return None
+    return time.perf_counter() - start_time
+
+
+def record_command(ctx: ipy.BaseContext, error: typing.Optional[Exception] = None):
+    # records how long a command took, and what it errored with (if it did)
+    command = getattr(ctx, "invoke_target", None) or "unknown"
+
+    if (latency := command_latency(ctx)) is not None:
+        metrics.REGISTRY.observe("command_latency_seconds", latency, command=command)
+
+    if error:
+        metrics.REGISTRY.increment(
+            "command_errors_total", command=command, error=type(error).__name__
+        )
+
+
+async def _metrics_prerun(ctx: CherubContext, *args, **kwargs):
+    ctx.metrics_start = time.perf_counter()  # type: ignore
+
+
+async def _metrics_postrun(ctx: CherubContext, *args, **kwargs):
+    # this only runs if the command succeeded - errors are recorded
+    # in on_command_error instead
+    record_command(ctx)
+
+
 class Extension(ipy.Extension):
     def __new__(cls, bot: CherubBase, *args, **kwargs):
         new_cls = super().__new__(cls, bot, *args, **kwargs)
         new_cls.add_ext_check(_global_checks)  # type: ignore
+        new_cls.add_extension_prerun(_metrics_prerun)  # type: ignore
+        new_cls.add_extension_postrun(_metrics_postrun)  # type: ignore
         return new_cls
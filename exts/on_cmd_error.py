@@ -20,6 +20,8 @@ class OnCMDError(ipy.Extension):
         self,
         event: ipy.events.CommandError,
     ):
+        utils.record_command(event.ctx, event.error)
+
         if not isinstance(
             event.ctx, (prefixed.PrefixedContext, ipy.InteractionContext)
         ):
@@ -13,6 +13,8 @@ from interactions.ext import prefixed_commands as prefixed
 from interactions.ext.debug_extension.utils import debug_embed
 from interactions.ext.debug_extension.utils import get_cache_state
 
+import common.metrics as metrics
+import common.models as models
 import common.utils as utils
 
 
@@ -58,6 +60,22 @@ class OwnerCMDs(ipy.Extension):
         e.description = f"```prolog\n{get_cache_state(self.bot)}\n```"
         await ctx.reply(embeds=[e])
 
+    @debug.subcommand()
+    async def metrics(self, ctx: prefixed.PrefixedContext) -> None:
+        """Get command, download, and image processing metrics."""
+        summary = metrics.REGISTRY.summary()
+
+        if len(summary) <= 4000:
+            e = debug_embed("Metrics")
+            e.description = f"```prolog\n{summary}\n```"
+            await ctx.reply(embeds=[e])
+            return
+
+        paginator = paginators.Paginator.create_from_string(
+            self.bot, summary, prefix="```prolog", suffix="```", page_size=4000
+        )
+        await paginator.reply(ctx)
+
     @debug.subcommand()
     async def shutdown(self, ctx: prefixed.PrefixedContext) -> None:
         """Shuts down the bot."""
@@ -82,6 +100,15 @@ class OwnerCMDs(ipy.Extension):
         self.bot.unload_extension(module)
         await ctx.reply(f"Unloaded `{module}`.")
 
+    @debug.subcommand(aliases=["compact-configs", "compact"])
+    async def compact_configs(self, ctx: prefixed.PrefixedContext) -> None:
+        """Deletes every config that has no pinboards."""
+        async with ctx.channel.typing:
+            result = await models.Config.find(models.Config.pinboards == []).delete()
+
+        deleted_count = result.deleted_count if result else 0
+        await ctx.reply(f"Deleted {deleted_count} empty config(s).")
+
     @prefixed.prefixed_command(aliases=["reloadallextensions"])
     async def reload_all_extensions(self, ctx: prefixed.PrefixedContext) -> None:
         for ext in (e.extension_name for e in self.bot.ext.copy().values()):
@@ -270,21 +297,11 @@ class OwnerCMDs(ipy.Extension):
                 await ctx.send("Nice try.")
             return
 
-        error_str = utils.error_format(error)
-        chunks = utils.line_split(error_str)
-
-        for i in range(len(chunks)):
-            chunks[i][0] = f"```py\n{chunks[i][0]}"
-            chunks[i][len(chunks[i]) - 1] += "\n```"
-
-        final_chunks = ["\n".join(chunk) for chunk in chunks]
+        jump_url = None
         if ctx and hasattr(ctx, "message") and hasattr(ctx.message, "jump_url"):
-            final_chunks.insert(0, f"Error on: {ctx.message.jump_url}")
-
-        to_send = final_chunks
-        split = False
+            jump_url = ctx.message.jump_url
 
-        await utils.msg_to_owner(self.bot, to_send, split)
+        self.bot.error_reporter.report(utils.error_format(error), jump_url)
 
         if hasattr(ctx, "send"):
             await ctx.send("An error occured. Please check your DMs.")
@@ -1,13 +1,33 @@
+import asyncio
 import contextlib
 import importlib
+import time
+import typing
 
 import interactions as ipy
 import tansy
+from beanie.operators import In
+from pymongo.errors import BulkWriteError
 
+import common.models as models
+import common.pinboard_utils as pinboard_utils
 import common.utils as utils
 
+# how many times sending a pin is tried before giving up
+PIN_SEND_ATTEMPTS = 3
+# how many channels can be backfilled at once
+BACKFILL_CONCURRENCY = 3
+# how often (in seconds) the backfill progress message is updated
+BACKFILL_PROGRESS_INTERVAL = 5
+
 
 class Pinboard(utils.Extension):
+    def __init__(self, bot: utils.CherubBase) -> None:
+        self.bot = bot
+        self.pin_queues: dict[int, asyncio.Queue[ipy.Message]] = {}
+        self.pin_workers: dict[int, asyncio.Task] = {}
+        self.renderer = pinboard_utils.PinRenderer()
+
     pinboard = tansy.SlashCommand(
         name="pinboard",
         description="Pinboard-related commands.",
@@ -17,14 +37,14 @@ class Pinboard(utils.Extension):
 
     @pinboard.subcommand(sub_cmd_name="list", sub_cmd_description="List all pinboards.")
     async def pinboard_list(self, ctx: utils.CherubSlashContext):
-        config = await utils.fetch_config(ctx.guild_id)
+        config = await utils.fetch_config(self.bot, ctx.guild_id)
 
         if not config.pinboards:
             raise utils.CustomCheckFailure("There are no pinboards on this server.")
 
         entries = [
-            f"{f'<#{k}>' if k != '0' else 'Global'} -> <#{v}>"
-            for k, v in config.pinboards.items()
+            f"{f'<#{p.entry_id}>' if p.entry_id else 'Global'} -> <#{p.destination_id}>"
+            for p in config.pinboards
         ]
         await ctx.send(embed=utils.make_embed("\n".join(entries), title="Pinboards"))
 
@@ -35,9 +55,9 @@ class Pinboard(utils.Extension):
         entry: ipy.GuildText = tansy.Option("The channel to watch for pins."),
         destination: ipy.GuildText = tansy.Option("The channel to send pins to."),
     ):
-        config = await utils.fetch_config(ctx.guild_id)
-        config.pinboards[str(entry.id)] = str(destination.id)
-        await config.save()
+        config = await utils.fetch_config(self.bot, ctx.guild_id)
+        config.set_pinboard(int(entry.id), int(destination.id))
+        await utils.save_config(self.bot, config)
 
         await ctx.send("Pinboard added.")
 
@@ -49,16 +69,151 @@ class Pinboard(utils.Extension):
         ctx: utils.CherubSlashContext,
         entry: ipy.GuildText = tansy.Option("The entry channel to remove."),
     ):
-        config = await utils.fetch_config(ctx.guild_id)
+        config = await utils.fetch_config(self.bot, ctx.guild_id)
 
-        if not config.pinboards.get(str(entry.id)):
+        if not config.remove_pinboard(int(entry.id)):
             raise utils.CustomCheckFailure("That channel is not a pinboard.")
 
-        config.pinboards.pop(str(entry.id))
-        await config.save()
+        await utils.save_config(self.bot, config)
 
         await ctx.send("Pinboard removed.")
 
+    @pinboard.subcommand(
+        sub_cmd_name="backfill",
+        sub_cmd_description=(
+            "Moves every existing pin in the entry channels to their pinboards."
+        ),
+    )
+    async def pinboard_backfill(self, ctx: utils.GuildInteractionContext):
+        config = await utils.fetch_config(self.bot, ctx.guild_id)
+
+        if not config.pinboards:
+            raise utils.CustomCheckFailure("There are no pinboards on this server.")
+
+        destination_ids = {p.destination_id for p in config.pinboards}
+        channels: list[tuple[ipy.GuildText, int]] = []
+
+        for channel in ctx.guild.channels:
+            if (
+                not isinstance(channel, ipy.GuildText)
+                or int(channel.id) in destination_ids
+            ):
+                continue
+
+            if destination_id := config.get_destination(int(channel.id)):
+                channels.append((channel, destination_id))
+
+        msg = await ctx.send(
+            embed=utils.make_embed("Fetching pins...", title="Pinboard Backfill")
+        )
+
+        semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+        forwarded = 0
+        failed = 0
+        failed_channels: list[str] = []
+        last_update = time.monotonic()
+
+        async def update_progress() -> None:
+            nonlocal last_update
+            if time.monotonic() - last_update < BACKFILL_PROGRESS_INTERVAL:
+                return
+
+            last_update = time.monotonic()
+            with contextlib.suppress(ipy.errors.HTTPException):
+                await ctx.edit(
+                    msg,
+                    embed=utils.make_embed(
+                        f"Forwarded {forwarded} pin(s) so far...",
+                        title="Pinboard Backfill",
+                    ),
+                )
+
+        async def backfill_channel(channel: ipy.GuildText, destination_id: int):
+            nonlocal forwarded, failed
+
+            async with semaphore:
+                try:
+                    pins: list[ipy.Message] = await channel.fetch_pinned_messages()
+                    destination = await self.fetch_destination(destination_id)
+                except ipy.errors.HTTPException:
+                    failed_channels.append(channel.mention)
+                    return
+
+                if not destination:
+                    failed_channels.append(channel.mention)
+                    return
+
+                forwarded_ids = await self.fetch_forwarded_ids(pins)
+                forwards: list[models.PinForward] = []
+
+                # pins come newest first, but the pinboard should read oldest first
+                # each channel is done in order, only channels run alongside each other
+                try:
+                    for pin in reversed(pins):
+                        try:
+                            if int(pin.id) not in forwarded_ids:
+                                forwards.append(await self.send_pin(destination, pin))
+                            await pin.unpin()
+                            forwarded += 1
+                        except ipy.errors.HTTPException:
+                            failed += 1
+
+                        await update_progress()
+                finally:
+                    await self.save_forwards(forwards)
+
+        await asyncio.gather(
+            *(backfill_channel(channel, dest_id) for channel, dest_id in channels)
+        )
+
+        summary = [f"Forwarded {forwarded} pin(s)."]
+        if failed:
+            summary.append(f"Failed to forward {failed} pin(s).")
+        if failed_channels:
+            summary.append(f"Couldn't get pins from: {', '.join(failed_channels)}")
+        summary_embed = utils.make_embed("\n".join(summary), title="Pinboard Backfill")
+
+        try:
+            await ctx.edit(msg, embed=summary_embed)
+        except ipy.errors.HTTPException:
+            # the interaction token most likely expired
+            await ctx.channel.send(ctx.author.mention, embed=summary_embed)
+
+    async def resolve_pinned_message(
+        self, message: ipy.Message
+    ) -> typing.Optional[ipy.Message]:
+        # the system message for a pin references the pinned message, so we can
+        # usually get it from the cache or with a single fetch instead of
+        # fetching every pin in the channel
+        if (reference := message.message_reference) and reference.message_id:
+            channel_id = reference.channel_id or message._channel_id
+
+            if pinned := self.bot.cache.get_message(channel_id, reference.message_id):
+                return pinned
+
+            with contextlib.suppress(ipy.errors.HTTPException):
+                if pinned := await message.channel.fetch_message(reference.message_id):
+                    return pinned
+
+        pins: list[ipy.Message] = await message.channel.fetch_pinned_messages()
+        return pins[0] if pins else None
+
+    @ipy.listen(ipy.events.GuildLeft)
+    async def forget_config(self, event: ipy.events.GuildLeft):
+        # the config is left in the database in case the bot is added back
+        self.bot.config_cache.pop(int(event.guild_id))
+        self.bot.pinboard_index.remove(int(event.guild_id))
+
+    @ipy.listen(ipy.events.GuildJoin)
+    async def index_config(self, event: ipy.events.GuildJoin):
+        # a guild the bot was added back to may still have pinboards set up
+        # guilds from startup are already indexed by load_configs
+        if not self.bot.fully_ready.is_set():
+            return
+
+        config = await utils.fetch_config(self.bot, event.guild_id)
+        self.bot.pinboard_index.update(config)
+
     @ipy.listen(ipy.events.MessageCreate)
     async def pinboard_listen(self, event: ipy.events.MessageCreate):
         if (
@@ -67,56 +222,152 @@ class Pinboard(utils.Extension):
         ):
             return
 
-        config = await utils.fetch_config(event.message._guild_id)
-        destination_id = config.pinboards.get(
-            str(event.message._channel_id), config.pinboards.get("0")
-        )
-        if not destination_id:
+        if not self.bot.pinboard_index.has_pinboard(
+            int(event.message._guild_id), int(event.message._channel_id)
+        ):
             return
 
-        pins: list[ipy.Message] = await event.message.channel.fetch_pinned_messages()
-        last_pin = pins[0]
+        config = await utils.fetch_config(self.bot, event.message._guild_id)
+        destination_id = config.get_destination(int(event.message._channel_id))
+        if not destination_id:
+            return
 
-        embed = ipy.Embed(
-            description=last_pin.content or last_pin.system_content,
-            color=ipy.RoleColors.LIGHTER_GRAY,
-            timestamp=last_pin.timestamp,
-        )
-        embed.set_author(
-            f"{last_pin.author.display_name} ({last_pin.author.tag})",
-            icon_url=last_pin.author.display_avatar.url,
-        )
+        self.queue_pin(destination_id, event.message)
 
-        if last_pin.attachments:
-            if first_image := next((a for a in last_pin.attachments if a.height), None):
-                embed.set_image(first_image.url)
+    def queue_pin(self, destination_id: int, message: ipy.Message) -> None:
+        # pins are forwarded one at a time per destination - otherwise, a burst of
+        # pins would race each other, and the fallback in resolve_pinned_message
+        # could end up forwarding the wrong pin
+        if destination_id not in self.pin_queues:
+            self.pin_queues[destination_id] = asyncio.Queue()
+        self.pin_queues[destination_id].put_nowait(message)
 
-            embed.add_field(
-                "Attachments",
-                "\n".join([f"[{x.filename}]({x.url})" for x in last_pin.attachments]),
+        worker = self.pin_workers.get(destination_id)
+        if not worker or worker.done():
+            self.pin_workers[destination_id] = asyncio.create_task(
+                self.pin_worker(destination_id)
             )
 
-        if not embed.description:
-            embed.description = "*See original message for content.*"
+    async def pin_worker(self, destination_id: int) -> None:
+        queue = self.pin_queues[destination_id]
 
-        destination = await self.bot.fetch_channel(int(destination_id))
-        if not destination:
+        while not queue.empty():
+            # take everything that's queued up at once, so that pins of the same
+            # message (ie from a pin, unpin, and repin) only get forwarded once
+            batch: dict[int, ipy.Message] = {}
+            while not queue.empty():
+                message: ipy.Message = queue.get_nowait()
+                reference = message.message_reference
+                key = (
+                    int(reference.message_id)
+                    if reference and reference.message_id
+                    else int(message.id)
+                )
+                batch.setdefault(key, message)
+
+            try:
+                await self.forward_pins(destination_id, list(batch.values()))
+            except Exception as e:
+                await utils.error_handle(self.bot, e)
+
+        # nothing can be queued between the empty check and here, as there's no
+        # await in between
+        del self.pin_queues[destination_id]
+        self.pin_workers.pop(destination_id, None)
+
+    async def fetch_destination(
+        self, destination_id: int
+    ) -> typing.Optional[ipy.GuildText]:
+        if channel := self.bot.get_channel(destination_id):
+            return channel  # type: ignore
+        return await self.bot.fetch_channel(destination_id)  # type: ignore
+
+    async def send_with_retry(
+        self, destination: ipy.GuildText, **kwargs: typing.Any
+    ) -> ipy.Message:
+        # ipy already waits out most ratelimits, but ones it can't predict
+        # (and discord having issues) can still slip through
+        attempt = 0
+        while True:
+            try:
+                return await destination.send(**kwargs)
+            except ipy.errors.HTTPException as e:
+                attempt += 1
+                if attempt >= PIN_SEND_ATTEMPTS or (e.status != 429 and e.status < 500):
+                    raise
+                await asyncio.sleep(2**attempt)
+
+    async def fetch_forwarded_ids(self, pins: list[ipy.Message]) -> set[int]:
+        forwards = await models.PinForward.find(
+            In(models.PinForward.source_id, [p.id for p in pins])
+        ).to_list()
+        return {f.source_id for f in forwards}
+
+    async def save_forwards(self, forwards: list[models.PinForward]) -> None:
+        if not forwards:
             return
 
-        await destination.send(
-            embed=embed,
-            components=ipy.Button(
-                style=ipy.ButtonStyle.LINK,
-                label="Original Message",
-                url=last_pin.jump_url,
-            ),
+        # duplicates can only come from a race with another forward of the same
+        # pin, in which case the existing record is just as good
+        with contextlib.suppress(BulkWriteError):
+            await models.PinForward.insert_many(forwards, ordered=False)
+
+    async def send_pin(
+        self, destination: ipy.GuildText, pin: ipy.Message
+    ) -> models.PinForward:
+        forwarded = await self.send_with_retry(destination, **self.renderer.render(pin))
+        return models.PinForward(
+            source_id=pin.id,
+            forwarded_id=forwarded.id,
+            destination_id=destination.id,
+            guild_id=pin._guild_id,
         )
-        await last_pin.unpin()
 
-        with contextlib.suppress(ipy.errors.HTTPException):
-            await event.message.delete()
+    async def forward_pins(
+        self, destination_id: int, messages: list[ipy.Message]
+    ) -> None:
+        # messages are the system messages discord sends for each pin
+        pins: list[tuple[ipy.Message, ipy.Message]] = []
+        for message in messages:
+            if pin := await self.resolve_pinned_message(message):
+                pins.append((message, pin))
+
+        if not pins:
+            return
+
+        destination = await self.fetch_destination(destination_id)
+        if not destination:
+            return
+
+        # pins that were already forwarded (ie if unpinning failed, or the bot
+        # reconnected and got the same events again) are only unpinned
+        forwarded_ids = await self.fetch_forwarded_ids([pin for _, pin in pins])
+        forwards: list[models.PinForward] = []
+
+        try:
+            for message, pin in pins:
+                try:
+                    if int(pin.id) not in forwarded_ids:
+                        forwards.append(await self.send_pin(destination, pin))
+                        forwarded_ids.add(int(pin.id))
+
+                    await pin.unpin()
+                except Exception as e:
+                    await utils.error_handle(self.bot, e)
+                    continue
+
+                with contextlib.suppress(ipy.errors.HTTPException):
+                    await message.delete()
+        finally:
+            await self.save_forwards(forwards)
+
+    def drop(self) -> None:
+        for worker in self.pin_workers.values():
+            worker.cancel()
+        super().drop()
 
 
 def setup(bot: utils.CherubBase):
     importlib.reload(utils)
+    importlib.reload(pinboard_utils)
     Pinboard(bot)
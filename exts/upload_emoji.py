@@ -1,21 +1,110 @@
 import asyncio
+import concurrent.futures
 import importlib
 import io
 import typing
 
+import aiohttp
 import interactions as ipy
 import tansy
-from PIL import Image
 
 import common.emoji_utils as emoji_utils
+import common.image_utils as image_utils
 import common.utils as utils
 
+# how many emojis can be prepared (downloaded and compressed) at once when adding
+# in bulk
+BULK_DOWNLOAD_CONCURRENCY = 5
+# discord's limit is 2000 characters, but a mention may be added to the summary
+SUMMARY_LIMIT = 1900
+
+
+def _failure_summary(failures: list[str], limit: int) -> str:
+    # lists as many failures as fit in the limit, noting how many didn't
+    lines = ["Failed to add:"]
+    length = len(lines[0])
+
+    for index, failure in enumerate(failures):
+        more = f"...and {len(failures) - index} more."
+        if length + len(failure) + len(more) + 2 > limit:
+            lines.append(more)
+            break
+
+        lines.append(failure)
+        length += len(failure) + 1
+
+    return "\n".join(lines)
+
 
 class UploadEmoji(utils.Extension):
     def __init__(self, bot: utils.CherubBase):
         self.bot = bot
         self.name = "Upload Emoji"
 
+    async def get_emoji_index(self, guild: ipy.Guild) -> emoji_utils.GuildEmojiIndex:
+        # only the first lookup for a guild has to fetch its emojis - after that,
+        # the index is kept up to date by the listeners below
+        if (index := self.bot.emoji_indexes.get(int(guild.id))) is None:
+            emojis = await guild.fetch_all_custom_emojis()
+            # a GuildEmojisUpdate may have come in during the fetch, and it's newer
+            if (index := self.bot.emoji_indexes.get(int(guild.id))) is None:
+                index = emoji_utils.GuildEmojiIndex(emojis)
+                self.bot.emoji_indexes[int(guild.id)] = index
+        return index
+
+    @ipy.listen(ipy.events.Ready)
+    async def clear_emoji_indexes(self, event: ipy.events.Ready):
+        # ready fires again when the bot gets a new session, and any emoji
+        # changes while it was disconnected were never seen - so start over
+        self.bot.emoji_indexes.clear()
+
+    @ipy.listen(ipy.events.GuildEmojisUpdate)
+    async def update_emoji_index(self, event: ipy.events.GuildEmojisUpdate):
+        self.bot.emoji_indexes[int(event.guild_id)] = emoji_utils.GuildEmojiIndex(
+            event.after
+        )
+
+    @ipy.listen(ipy.events.GuildLeft)
+    async def remove_emoji_index(self, event: ipy.events.GuildLeft):
+        self.bot.emoji_indexes.pop(int(event.guild_id), None)
+
+    async def _is_animated(self, raw_data: bytes | memoryview, emoji_ext: str) -> bool:
+        if emoji_ext not in emoji_utils.ANIMATABLE_EXTS:
+            return False
+
+        # you see, gifs (and webps) can be animated or not animated
+        # webps say which in their header, but gifs have to be checked via
+        # an admittedly risky operation
+        animated = emoji_utils.animated_from_bytes(raw_data)
+        if animated is None:
+            try:
+                animated = await self.bot.image_processor.is_animated(raw_data)
+            except image_utils.IMAGE_ERRORS:
+                raise ipy.errors.BadArgument(
+                    f"Invalid {emoji_ext.upper()} provided."
+                ) from None
+        return animated
+
+    async def _fit_to_emoji(
+        self, raw_data: bytes | memoryview, emoji_ext: str
+    ) -> bytes | bytearray | memoryview:
+        # over 256 KiB, we need to compress the image
+        if len(raw_data) <= image_utils.EMOJI_SIZE_LIMIT:
+            return raw_data
+
+        try:
+            raw_data = await self.bot.image_processor.fit_to_emoji(raw_data, emoji_ext)
+        except image_utils.IMAGE_ERRORS:
+            raise ipy.errors.BadArgument(
+                f"Invalid {emoji_ext.upper()} provided."
+            ) from None
+
+        if len(raw_data) > image_utils.EMOJI_SIZE_LIMIT:
+            raise ipy.errors.BadArgument(
+                "The image provided is too large to be uploaded."
+            )
+        return raw_data
+
     @tansy.slash_command(
         name="add-emoji",
         description="Adds the URL, emoji, or image given as an emoji to this server.",
@@ -49,6 +138,7 @@ class UploadEmoji(utils.Extension):
         emoji_url = None
         emoji_ext = None
         emoji_name = name
+        raw_data = None
 
         if emoji:
             try:
@@ -68,11 +158,19 @@ class UploadEmoji(utils.Extension):
                 emoji_name = emoji_name or partial_emoji.name
 
             except ipy.errors.BadArgument:
-                emoji_url, emoji_ext = await emoji_utils.get_image_url(emoji)
-                if not emoji_url or not emoji_ext:
+                # 8 MiB seems like a reasonable limit
+                emoji_ext, raw_data = await emoji_utils.get_image_with_limit(
+                    self.bot.session,
+                    emoji,
+                    8388608,
+                    scheduler=self.bot.download_scheduler,
+                    guild_id=int(ctx.guild_id),
+                )
+                if not emoji_ext or raw_data is None:
                     raise ipy.errors.BadArgument(
                         "This argument is not a valid emoji or image URL."
                     ) from None
+                emoji_url = emoji
                 emoji_name = (
                     emoji_name or emoji_url.split("/")[-1].split(".", maxsplit=1)[0]
                 )
@@ -93,72 +191,36 @@ class UploadEmoji(utils.Extension):
             # no idea how this would happen
             raise ipy.errors.BadArgument("Invalid argument passed.")
 
-        guild_emojis = await ctx.guild.fetch_all_custom_emojis()
+        emoji_index = await self.get_emoji_index(ctx.guild)
 
         if emoji_id:
-            if next((e for e in guild_emojis if e.id and int(e.id) == emoji_id), None):
+            if emoji_index.has_id(emoji_id):
                 raise utils.CustomCheckFailure("This emoji is already on this server.")
 
-        elif next((e for e in guild_emojis if e.name == emoji_name), None):
+        elif emoji_index.has_name(emoji_name):
             raise utils.CustomCheckFailure(
                 f"There is already an emoji named `{emoji_name}`."
             )
 
-        animated = False
-        # 8 MiB seems like a reasonable limit
-        raw_data = await emoji_utils.get_file_with_limit(emoji_url, 8388608)
-        emoji_data = io.BytesIO(raw_data)
-
-        if emoji_ext == "gif":
-            # you see, gifs can be animated or not animated
-            # so we need to check for that via an admittedly risky operation
-
-            emoji_image = None
-
-            try:
-                # i think this operation is basic enough not to need a generator?
-                # not totally sure, though
-                emoji_image = Image.open(emoji_data)
-                animated = emoji_image.is_animated
-            except:
-                if emoji_image:
-                    emoji_image.close()
-                raise ipy.errors.BadArgument("Invalid GIF provided.")
-            else:
-                emoji_data.seek(0)
-
-        if animated:
-            emoji_count = len(tuple(e for e in guild_emojis if e.animated))
-        else:
-            emoji_count = len(tuple(e for e in guild_emojis if not e.animated))
+        if raw_data is None:
+            # 8 MiB seems like a reasonable limit
+            raw_data = await emoji_utils.get_file_with_limit(
+                self.bot.session,
+                emoji_url,
+                8388608,
+                cache=self.bot.emoji_cache,
+                scheduler=self.bot.download_scheduler,
+                guild_id=int(ctx.guild_id),
+            )
 
-        if emoji_count >= ctx.guild.emoji_limit:
+        animated = await self._is_animated(raw_data, emoji_ext)
+        if emoji_index.count(animated=animated) >= ctx.guild.emoji_limit:
             raise utils.CustomCheckFailure(
                 "This guild has no more emoji slots for that type of emoji."
             )
 
-        # over 256 KiB, we need to compress the image
-        if emoji_data.getbuffer().nbytes > 262144:
-            emoji_image = Image.open(emoji_data)
-
-            try:
-                if emoji_image.width > 256 or emoji_image.height > 256:
-                    emoji_image.thumbnail((256, 256))
-
-                emoji_data = io.BytesIO()
-                emoji_image.save(emoji_data, format=emoji_ext, optimize=True)
-                emoji_data.seek(0)
-            except Exception:
-                raise ipy.errors.BadArgument(
-                    "The image provided is too large to be uploaded."
-                ) from None
-            finally:
-                emoji_image.close()
-
-            if emoji_data.getbuffer().nbytes > 262144:
-                raise ipy.errors.BadArgument(
-                    "The image provided is too large to be uploaded."
-                )
+        raw_data = await self._fit_to_emoji(raw_data, emoji_ext)
+        emoji_data = io.BytesIO(raw_data)
 
         try:
             uploaded_emoji = await ctx.guild.create_custom_emoji(
@@ -185,8 +247,109 @@ class UploadEmoji(utils.Extension):
         finally:
             emoji_data.close()
 
+        emoji_index.add(uploaded_emoji)
         await ctx.send(f"Added {str(uploaded_emoji)}!")
 
+    async def _prepare_emoji(
+        self, guild_id: int, emoji_url: str
+    ) -> tuple[bytes | bytearray | memoryview, bool]:
+        # gets an emoji ready to be uploaded, returning its data and if it's animated
+        raw_data = await emoji_utils.get_file_with_limit(
+            self.bot.session,
+            emoji_url,
+            8388608,
+            cache=self.bot.emoji_cache,
+            scheduler=self.bot.download_scheduler,
+            guild_id=guild_id,
+        )
+
+        # the url's extension isn't trustworthy, so go off of the data itself
+        emoji_ext = emoji_utils.type_from_bytes(raw_data)
+        if emoji_ext not in emoji_utils.IMAGE_EXTS:
+            raise ipy.errors.BadArgument("This is not a valid image.")
+
+        animated = await self._is_animated(raw_data, emoji_ext)
+        return await self._fit_to_emoji(raw_data, emoji_ext), animated
+
+    async def _bulk_add_emojis(
+        self, ctx: utils.GuildInteractionContext, emoji_entries: list[str]
+    ) -> tuple[list[ipy.CustomEmoji], list[str]]:
+        # prepares every emoji first, and only starts uploading once it's known
+        # that all of them will fit - that way, we never end up with half a batch
+        # failures are collected instead of stopping the whole batch
+        semaphore = asyncio.Semaphore(BULK_DOWNLOAD_CONCURRENCY)
+        expected_errors = (
+            ipy.errors.BadArgument,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+        )
+
+        async def prepare(
+            emoji_url: str,
+        ) -> tuple[bytes | bytearray | memoryview, bool] | Exception:
+            async with semaphore:
+                try:
+                    return await self._prepare_emoji(int(ctx.guild_id), emoji_url)
+                except concurrent.futures.process.BrokenProcessPool:
+                    # a worker died, failing whatever the pool was running - the
+                    # pool gets replaced, so treat it like any other failure
+                    return ipy.errors.BadArgument("The image could not be processed.")
+                except expected_errors as e:
+                    return e
+
+        entries = [entry.split("|", maxsplit=1) for entry in emoji_entries]
+        results = await asyncio.gather(
+            *(prepare(emoji_url) for _, emoji_url in entries), return_exceptions=True
+        )
+        # anything else is a bug, but it's only raised once every emoji is done
+        # so nothing's left running in the background
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(
+                result, expected_errors
+            ):
+                raise result
+
+        prepared: list[tuple[str, bytes | bytearray | memoryview, bool]] = []
+        failures: list[str] = []
+
+        for (emoji_name, _), result in zip(entries, results):
+            if isinstance(result, Exception):
+                failures.append(f"`{emoji_name}`: {result}")
+            else:
+                prepared.append((emoji_name, *result))
+
+        emoji_index = await self.get_emoji_index(ctx.guild)
+
+        for animated, emoji_type in ((True, "animated"), (False, "static")):
+            new_count = sum(1 for _, _, a in prepared if a == animated)
+            slots_left = ctx.guild.emoji_limit - emoji_index.count(animated=animated)
+
+            if new_count > slots_left:
+                raise ipy.errors.BadArgument(
+                    f"This guild only has {max(slots_left, 0)} slot(s) left for"
+                    f" {emoji_type} emojis, but {new_count} were selected."
+                )
+
+        uploaded_emojis: list[ipy.CustomEmoji] = []
+
+        # uploads share a ratelimit bucket anyways, and ipy will wait on that for us
+        for emoji_name, raw_data, _ in prepared:
+            emoji_data = io.BytesIO(raw_data)
+            try:
+                uploaded_emoji = await ctx.guild.create_custom_emoji(
+                    name=emoji_name,
+                    imagefile=emoji_data,
+                    reason=f"Created by {str(ctx.author)}.",
+                )
+                uploaded_emojis.append(uploaded_emoji)
+                emoji_index.add(uploaded_emoji)
+            except ipy.errors.HTTPException as e:
+                failures.append(f"`{emoji_name}`: {e}")
+            finally:
+                emoji_data.close()
+
+        return uploaded_emojis, failures
+
     @tansy.slash_command(
         name="clone-emoji",
         description="Clones an emoji from one server to this one.",
@@ -243,8 +406,7 @@ class UploadEmoji(utils.Extension):
         if not (matches := emoji_utils.DISCORD_EMOJI_REGEX.findall(message.content)):
             raise ipy.errors.BadArgument("No emojis found in this message.")
 
-        guild_emojis = await ctx.guild.fetch_all_custom_emojis()
-        guild_emoji_ids = frozenset({int(e.id) for e in guild_emojis if e.id})
+        emoji_index = await self.get_emoji_index(ctx.guild)
 
         emoji_options: list[ipy.StringSelectOption] = []
         emoji_ids: set[int] = set()
@@ -256,7 +418,7 @@ class UploadEmoji(utils.Extension):
                 id=emoji_id, name=emoji_name, animated=bool(match[0])
             )
 
-            if emoji_id in guild_emoji_ids:
+            if emoji_index.has_id(emoji_id):
                 continue
 
             if emoji_id in emoji_ids:
@@ -302,75 +464,25 @@ class UploadEmoji(utils.Extension):
             )
             await menu_event.ctx.defer(ephemeral=True)
 
-            new_animated_emojis_size = 0
-            new_static_emojis_size = 0
-
-            animated_emoji_count = len(tuple(e for e in guild_emojis if e.animated))
-            normal_emoji_count = len(tuple(e for e in guild_emojis if not e.animated))
-
-            for emoji_entry in menu_event.ctx.values:
-                if emoji_entry.endswith(".gif"):
-                    new_animated_emojis_size += 1
-                else:
-                    new_static_emojis_size += 1
-
-            if animated_emoji_count + new_animated_emojis_size > ctx.guild.emoji_limit:
-                raise ipy.errors.BadArgument(
-                    "This guild has no more emoji slots for animated emojis."
-                )
-
-            if normal_emoji_count + new_static_emojis_size > ctx.guild.emoji_limit:
-                raise ipy.errors.BadArgument(
-                    "This guild has no more emoji slots for static emojis."
-                )
-
-            uploaded_emojis: list[ipy.CustomEmoji] = []
-
-            for emoji_entry in menu_event.ctx.values:
-                emoji_split = emoji_entry.split("|")
-                emoji_url = emoji_split[1]
-                emoji_data_bytes = await emoji_utils.get_file_with_limit(
-                    emoji_url, 262144
-                )
-                emoji_data = io.BytesIO(emoji_data_bytes)
-
-                try:
-                    uploaded_emoji = await ctx.guild.create_custom_emoji(
-                        name=emoji_split[0],
-                        imagefile=emoji_data,
-                        reason=f"Created by {str(ctx.author)}.",
-                    )
-                    uploaded_emojis.append(uploaded_emoji)
-                except ipy.errors.HTTPException as e:
-                    raise utils.CustomCheckFailure(
-                        "".join(
-                            (
-                                (
-                                    f"I was unable to add {emoji_split[0]}. This might"
-                                    " be due to me not having the "
-                                ),
-                                (
-                                    "permissions or the name being improper in some"
-                                    " way. Maybe this error will help you.\n\n"
-                                ),
-                                f"Error: `{e}`",
-                            )
-                        )
-                    ) from None
-                finally:
-                    emoji_data.close()
+            uploaded_emojis, failures = await self._bulk_add_emojis(
+                ctx, menu_event.ctx.values
+            )
 
-            emoji_list = ", ".join(str(e) for e in uploaded_emojis)
+            # at most 25 emojis are added at once, so the list of them always fits
+            summary: list[str] = []
+            if uploaded_emojis:
+                emoji_list = ", ".join(str(e) for e in uploaded_emojis)
+                summary.append(f"Successfully added emojis: {emoji_list}")
+            if failures:
+                used = sum(len(s) + 2 for s in summary)
+                summary.append(_failure_summary(failures, SUMMARY_LIMIT - used))
+            summary_str = "\n\n".join(summary)
 
             if not ipy.Timestamp.utcnow() > menu_event.ctx.expires_at:
-                await menu_event.ctx.send(
-                    content=f"Successfully added emojis: {emoji_list}", ephemeral=True
-                )
+                await menu_event.ctx.send(content=summary_str, ephemeral=True)
             else:
                 await ctx.channel.send(
-                    content=(
-                        f"{ctx.author.mention}, successfully added emojis: {emoji_list}"
-                    ),
+                    content=f"{ctx.author.mention}:\n{summary_str}",
                     delete_after=10,
                 )
 
@@ -386,4 +498,5 @@ class UploadEmoji(utils.Extension):
 def setup(bot):
     importlib.reload(utils)
     importlib.reload(emoji_utils)
+    importlib.reload(image_utils)
     UploadEmoji(bot)
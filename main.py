@@ -14,16 +14,12 @@ from beanie import init_beanie
 
 import common.utils as utils
 import common.models as models
+import common.emoji_utils as emoji_utils
+import common.image_utils as image_utils
+import common.log_utils as log_utils
+import common.metrics as metrics
 
 logger = logging.getLogger("cherub")
-logger.setLevel(logging.INFO)
-handler = logging.FileHandler(
-    filename=os.environ["LOG_FILE_PATH"], encoding="utf-8", mode="a"
-)
-handler.setFormatter(
-    logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
-)
-logger.addHandler(handler)
 
 intents = ipy.Intents.new(
     guilds=True,
@@ -92,23 +88,76 @@ async def on_resume_func() -> None:
 
 async def start():
     bot.fully_ready = asyncio.Event()
+    bot.error_reporter = utils.ErrorReporter(bot)
+    bot.error_reporter.start()
+    bot.session = emoji_utils.create_session()
+    # 32 MiB by default, or four max-size downloads at once
+    bot.download_scheduler = emoji_utils.DownloadScheduler(
+        max_bytes=int(os.environ.get("DOWNLOAD_MAX_BYTES", 33554432)),
+        max_per_host=int(os.environ.get("DOWNLOAD_MAX_PER_HOST", 4)),
+        max_per_guild=int(os.environ.get("DOWNLOAD_MAX_PER_GUILD", 3)),
+        total_timeout=float(os.environ.get("DOWNLOAD_TIMEOUT", 30)),
+        idle_timeout=float(os.environ.get("DOWNLOAD_IDLE_TIMEOUT", 10)),
+    )
+    bot.emoji_indexes = {}
+    bot.config_cache = utils.ConfigCache(
+        int(os.environ.get("CONFIG_CACHE_CAPACITY", 1000))
+    )
+    bot.emoji_cache = None
+    if cache_path := os.environ.get("EMOJI_CACHE_PATH"):
+        # 256 MiB by default, which is around a thousand emojis at worst
+        bot.emoji_cache = emoji_utils.EmojiCache(
+            cache_path, int(os.environ.get("EMOJI_CACHE_MAX_SIZE", 268435456))
+        )
+    bot.image_processor = image_utils.ImageProcessor(
+        int(os.environ.get("IMAGE_PROCESSING_WORKERS", 2))
+    )
     client = AsyncIOMotorClient(os.environ["MONGO_DB_URL"])
-    await init_beanie(client.Cherub, document_models=[models.Config])
+    await init_beanie(client.Cherub, document_models=[models.Config, models.PinForward])
+    if migrated := await models.migrate_configs():
+        logger.info(f"Migrated {migrated} configs to version {models.CONFIG_VERSION}.")
+    await utils.load_configs(bot)
 
     ext_list = utils.get_all_extensions(os.environ.get("DIRECTORY_OF_BOT"))
     for ext in ext_list:
         bot.load_extension(ext)
 
-    await bot.astart(os.environ["MAIN_TOKEN"])
-
-
-loop_factory = None
+    metrics_runner = None
+    if metrics_port := os.environ.get("METRICS_PORT"):
+        metrics_runner = await metrics.start_server(
+            os.environ.get("METRICS_HOST", "127.0.0.1"), int(metrics_port)
+        )
+
+    try:
+        await bot.astart(os.environ["MAIN_TOKEN"])
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        bot.error_reporter.stop()
+        await bot.session.close()
+        bot.image_processor.close()
+        log_listener.stop()
+
+
+# image processing workers import this file too, so anything that shouldn't
+# happen in them (like setting up logging, which starts a thread) goes here
+if __name__ == "__main__":
+    logger.setLevel(logging.INFO)
+    log_listener = log_utils.setup_logging(
+        logger,
+        os.environ["LOG_FILE_PATH"],
+        json_format=os.environ.get("LOG_FORMAT", "").lower() == "json",
+        max_bytes=int(os.environ.get("LOG_MAX_BYTES", 0)),
+        backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 5)),
+        rotate_when=os.environ.get("LOG_ROTATE_WHEN"),
+    )
 
-with contextlib.suppress(ImportError):
-    import uvloop  # type: ignore
+    loop_factory = None
 
-    loop_factory = uvloop.new_event_loop
+    with contextlib.suppress(ImportError):
+        import uvloop  # type: ignore
 
+        loop_factory = uvloop.new_event_loop
 
-with asyncio.Runner(loop_factory=loop_factory) as runner:
-    asyncio.run(start())
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        asyncio.run(start())